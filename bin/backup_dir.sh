@@ -12,23 +12,52 @@
 # * python-boto
 #
 # See below for the gpgxz.sh and s3up.py helper scripts.
+#
+# The archive is streamed straight into s3up, so it never touches the
+# local disk.
+#
+# To restore, stream it back with s3down.py, e.g.:
+#   s3down.py miketigas-backup 20130101-00-UTC/dir-20130101-0000.tar.xz.gpg - \
+#       | tar -xf - -Igpgxz.sh
+#
+# Set BACKUP_RATE_LIMIT (e.g. "2M", in bytes/second) to keep the upload
+# from saturating the uplink; otherwise s3up's MAX_UPLOAD_RATE and
+# UPLOAD_RATE_SCHEDULE apply.
+
+# Set BACKUP_DEDUP=1 to make an incremental, deduplicated backup with
+# s3dedup.py instead: only the parts of files that changed since the last
+# backup are uploaded. (Restore with `s3dedup.py restore`.)
+# Note that these backups are NOT encrypted with GPG: chunks are stored
+# private and encrypted at rest by S3 (SSE-S3), so anyone holding the AWS
+# keys can read them.
+if [ -n "$BACKUP_DEDUP" ]; then
+    echo
+    echo "Backing up changes to S3 store"
+    exec s3dedup.py backup --bucket=miketigas-backup $1
+fi
 
 export BACKUPDATE=`date +"%Y%m%d-%H%M"`
-export BACKUP_FILE=/tmp/$1-$BACKUPDATE.tar.xz.gpg
 export BACKUP_FILE_BASENAME=$1-$BACKUPDATE.tar.xz.gpg
+BACKUP_KEY=`date -u +"%Y%m%d-%H"`-UTC/$BACKUP_FILE_BASENAME
 
 echo
-echo "Removing existing backup file (if applicable)"
-rm $BACKUP_FILE
-
-echo
-echo
-tar -cf $BACKUP_FILE -Igpgxz.sh $1 --exclude-caches-all --exclude="*.pyo" --exclude="*.pyc"
+echo "Streaming backup to S3 store"
+tar -cf - -Igpgxz.sh $1 --exclude-caches-all --exclude="*.pyo" --exclude="*.pyc" \
+    | s3up.py ${BACKUP_RATE_LIMIT:+--limit-rate=$BACKUP_RATE_LIMIT} \
+        - miketigas-backup $BACKUP_KEY 0 "private"
 
-echo
-echo "Uploading backup to S3 store"
-s3up.py $BACKUP_FILE miketigas-backup `date -u +"%Y%m%d-%H"`-UTC/$BACKUP_FILE_BASENAME 0 "private"
-
-echo
-echo "Removing archive from temp dir"
-rm $BACKUP_FILE
+# s3up only sees the end of its input, so check that the archive itself
+# was written out completely, and don't leave a truncated one in the bucket
+# looking like a good backup.
+STATUS=("${PIPESTATUS[@]}")
+if [ "${STATUS[0]}" != "0" ]; then
+    echo "tar exited with status ${STATUS[0]}; deleting the incomplete backup." >&2
+    PYTHONPATH="$(dirname "$0")" python -c '
+import sys, s3up
+from boto.s3.connection import S3Connection
+S3Connection(s3up.AWS_ACCESS_KEY_ID, s3up.AWS_SECRET_ACCESS_KEY,
+    host=s3up.S3_ENDPOINT).get_bucket(sys.argv[1], validate=False) \
+    .delete_key(sys.argv[2])' miketigas-backup "$BACKUP_KEY"
+    exit 1
+fi
+exit ${STATUS[1]}
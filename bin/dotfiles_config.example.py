@@ -14,7 +14,27 @@ BUCKET_CNAME = ''
 # Options for s3up & s3up-dir, for files larger than 5MB:
 UPLOAD_PARALLELIZATION = 4
 CHUNK_SIZE = 5242880 # (Note: must be >= 5242880 (5MB))
+MULTIPART_THRESHOLD = 5242880 # (smaller files are sent with a single PUT)
 CHUNK_RETRIES = 10
+ADAPTIVE_UPLOAD = False # (tune the two options above while uploading)
+MAX_UPLOAD_PARALLELIZATION = 32
+MAX_CHUNK_SIZE = 268435456
+DIR_UPLOAD_PARALLELIZATION = 16 # (s3up-dir: shared by all files being uploaded)
+DOWNLOAD_PARALLELIZATION = None # (s3down: ranged GETs at once; default UPLOAD_PARALLELIZATION)
+LIST_PARALLELIZATION = 16 # (also s3search, s3-clear-multipart-uploads: listing threads)
+ABORT_PARALLELIZATION = 16 # (s3-clear-multipart-uploads: uploads aborted at once)
+RESUMABLE_UPLOADS = False # (keep uploaded chunks on failure; see `s3up --resume`)
+JOURNAL_DIR = '~/.s3up/journal'
+CHECKSUM_SHA256 = False # (also hash every chunk with SHA-256; see `s3up --sha256`)
+MAX_UPLOAD_RATE = None # (bytes/second for all threads together; see `s3up --limit-rate`)
+UPLOAD_RATE_SCHEDULE = [] # (e.g. [("09:00", "18:00", 1048576)] to slow down during the day)
+PROGRESS = 'auto' # ('bar', 'json', 'both' or 'none'; 'auto' is a bar on terminals)
+PROGRESS_LOG = None # (file to write 'json' progress lines to, instead of stderr)
+PROGRESS_INTERVAL = 1.0
+
+# s3dedup (and `BACKUP_DEDUP=1 backup_dir.sh`) uses the s3up options above.
+# Unlike backup_dir.sh's archives, its backups are not encrypted with GPG:
+# they are private and encrypted at rest by S3 (SSE-S3) only.
 
 # s3up-private, s3-genlink
 import hashlib
@@ -16,125 +16,277 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import glob
+import signal
 import subprocess
 import StringIO
 import os
 import sys
+import tempfile
 import traceback
+from multiprocessing import cpu_count
+from Queue import Queue
+from threading import Lock, Thread
 
 # 0-127
 DEFAULT_VBRQ=105
 
-def convert(vbrq=DEFAULT_VBRQ):
-    print "Converting FLAC files to AAC..."
-    
-    for infile in glob.iglob('*.flac'):
-        #infile = os.path.abspath(infile)
-        
-        file_parts = infile.rsplit('.',1)
-        wavfile = file_parts[0]+'.wav'
-        outfile = file_parts[0]+'.m4a'
-
-        p = subprocess.Popen([
-                'flac',
-                '-d',
-                '-f',
-                '%s' % infile],
-            executable="flac")
-            
-        p.wait()
-        
-        p = subprocess.Popen([
-                'metaflac',
-                '--export-tags-to=-',
-                '%s' % infile],
-            executable='metaflac',
-            stdout=subprocess.PIPE,
+# Number of tracks converted at once (each one runs its own flac, afconvert
+# and AtomicParsley processes).
+DEFAULT_JOBS = cpu_count()
+
+# What encodes the decoded audio to ALAC:
+#   "ffmpeg"    reads it straight from `flac` through a pipe, without writing
+#               a WAV file, and writes the tags in the same pass.
+#   "afconvert" can't read from a pipe, so `flac` decodes each track to a
+#               temporary WAV file first; AtomicParsley then adds the tags.
+#   "auto"      uses ffmpeg if it is installed, afconvert otherwise.
+DEFAULT_ENCODER = 'auto'
+
+# FLAC tags (see `tags`) are called differently by ffmpeg.
+FFMPEG_TAGS = {'year': 'date', 'tracknum': 'track', 'disk': 'disc'}
+
+def run(cmd, **kwargs):
+    """
+    Runs `cmd`, returning its output. Raises if it fails, with the last
+    thing it said on stderr.
+    """
+    p = subprocess.Popen(cmd, executable=cmd[0], stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, **kwargs)
+    out, err = p.communicate()
+    if p.returncode != 0:
+        err = err.strip().splitlines()
+        raise Exception("%s exited with status %d%s" % (cmd[0], p.returncode,
+            err and ": " + err[-1] or ""))
+    return out
+
+def run_pipeline(decode_cmd, encode_cmd):
+    """
+    Runs `decode_cmd` with its stdout piped to the stdin of `encode_cmd`.
+    Raises if either of them fails.
+    """
+    # Not a pipe, which could fill up while we wait for the encoder.
+    decode_err = tempfile.TemporaryFile()
+    # Python ignores SIGPIPE, and the decoder would inherit that instead of
+    # dying of it when the encoder goes away.
+    decoder = subprocess.Popen(decode_cmd, executable=decode_cmd[0],
+        stdout=subprocess.PIPE, stderr=decode_err,
+        preexec_fn=lambda: signal.signal(signal.SIGPIPE, signal.SIG_DFL))
+    try:
+        encoder = subprocess.Popen(encode_cmd, executable=encode_cmd[0],
+            stdin=decoder.stdout, stdout=subprocess.PIPE,
             stderr=subprocess.PIPE)
+    except:
+        # Nothing will ever read what the decoder writes.
+        decoder.kill()
+        decoder.wait()
+        raise
+    finally:
+        # Only the encoder has it open now, so the decoder gets SIGPIPE if
+        # the encoder dies.
+        decoder.stdout.close()
+    encoded, encode_err = encoder.communicate()
+    if encoder.returncode != 0 and decoder.poll() is None:
+        # Still waiting to write more.
+        decoder.send_signal(signal.SIGTERM)
+    decoder.wait()
+    decode_err.seek(0)
+    decode_err = decode_err.read()
+
+    results = [(decode_cmd, decoder, decode_err),
+        (encode_cmd, encoder, encode_err)]
+    if decoder.returncode < 0:
+        # Killed (or SIGPIPE) because the encoder gave up, which is what
+        # went wrong in the first place.
+        results.reverse()
+    for cmd, p, err in results:
+        if p.returncode != 0:
+            err = err.strip().splitlines()
+            raise Exception("%s exited with status %d%s" % (cmd[0],
+                p.returncode, err and ": " + err[-1] or ""))
 
-        data = p.communicate()
-        data = data[0].splitlines()
-        info = {}
-        for i in data:
-            i = i.split('=')
+def have_program(name):
+    return any(os.access(os.path.join(d, name), os.X_OK)
+        for d in os.environ.get('PATH', '').split(os.pathsep))
+
+def read_tags(infile):
+    info = {}
+    for i in run(['metaflac', '--export-tags-to=-', infile]).splitlines():
+        i = i.split('=', 1)
+        if len(i) == 2:
             info[i[0].upper()] = i[1]
-        
-        
-        CONVERT_CMD = [
-            'afconvert',
-            '-q','127',
-            '-f','m4af',
-            '-d','alac'
-        ]
-        
-        CONVERT_CMD.append('%s' % wavfile)
-        CONVERT_CMD.append('%s' % outfile)
-        
+    return info
+
+def tags(info):
+    """
+    The iTunes tags for the FLAC tags in `info`, as `(name, value)` pairs
+    named like AtomicParsley's options.
+    """
+    TAGS = []
+    if info.has_key('TITLE'):
+        TAGS.append(('title', info['TITLE']))
+    if info.has_key('ARTIST'):
+        TAGS.append(('artist', info['ARTIST']))
+    if info.has_key('ALBUM'):
+        TAGS.append(('album', info['ALBUM']))
+    if info.has_key('DATE'):
+        TAGS.append(('year', info['DATE']))
+    if info.has_key('TRACK'):
+        if info.has_key('TRACKTOTAL'):
+            TAGS.append(('tracknum', '%s/%s' % (info['TRACK'],info['TRACKTOTAL'])))
+        else:
+            TAGS.append(('tracknum', info['TRACK']))
+    elif info.has_key('TRACKNUMBER'):
+        if info.has_key('TRACKTOTAL'):
+            TAGS.append(('tracknum', '%s/%s' % (info['TRACKNUMBER'],info['TRACKTOTAL'])))
+        else:
+            TAGS.append(('tracknum', info['TRACKNUMBER']))
+    if info.has_key('DISC'):
+        if info.has_key('DISCTOTAL'):
+            TAGS.append(('disk', '%s/%s' % (info['DISC'],info['DISCTOTAL'])))
+        else:
+            TAGS.append(('disk', '%s/1' % info['DISC']))
+    else:
+        TAGS.append(('disk', '1/1'))
+    if info.has_key('GENRE'):
+        TAGS.append(('genre', info['GENRE']))
+    if info.has_key('COPYRIGHT'):
+        TAGS.append(('copyright', info['COPYRIGHT']))
+    return TAGS
+
+def atomicparsley_args(info):
+    args = []
+    for name, value in tags(info):
+        args += ['--' + name, value]
+    return args
+
+def ffmpeg_args(info):
+    args = []
+    for name, value in tags(info):
+        args += ['-metadata', '%s=%s' % (FFMPEG_TAGS.get(name, name), value)]
+    return args
+
+def convert_file(infile, vbrq=DEFAULT_VBRQ, encoder='afconvert'):
+    """
+    Converts one FLAC file to a tagged ALAC `.m4a` next to it, with
+    `encoder` (see `DEFAULT_ENCODER`). Raises if any step fails, leaving no
+    partial output behind.
+    """
+    file_parts = infile.rsplit('.',1)
+    wavfile = file_parts[0]+'.wav'
+    outfile = file_parts[0]+'.m4a'
+
+    try:
+        info = read_tags(infile)
+
         if os.path.exists(outfile):
             os.unlink(outfile)
-        
-        p = subprocess.Popen(CONVERT_CMD,executable="afconvert")
-        p.wait()
-        os.unlink(wavfile)
-        
-        TAGS_CMD = [
-            'AtomicParsley',
-            '%s' % outfile,
-            '--freefree'
-        ]
-        if info.has_key('TITLE'):
-            TAGS_CMD.append('--title')
-            TAGS_CMD.append('%s' % info['TITLE'])
-        if info.has_key('ARTIST'):
-            TAGS_CMD.append('--artist')
-            TAGS_CMD.append('%s' % info['ARTIST'])
-        if info.has_key('ALBUM'):
-            TAGS_CMD.append('--album')
-            TAGS_CMD.append('%s' % info['ALBUM'])
-        if info.has_key('DATE'):
-            TAGS_CMD.append('--year')
-            TAGS_CMD.append('%s' % info['DATE'])
-        if info.has_key('TRACK'):
-            TAGS_CMD.append('--tracknum')
-            if info.has_key('TRACKTOTAL'):
-                TAGS_CMD.append('%s/%s' % (info['TRACK'],info['TRACKTOTAL']))
-            else:
-                TAGS_CMD.append('%s' % info['TRACK'])
-        elif info.has_key('TRACKNUMBER'):
-            TAGS_CMD.append('--tracknum')
-            if info.has_key('TRACKTOTAL'):
-                TAGS_CMD.append('%s/%s' % (info['TRACKNUMBER'],info['TRACKTOTAL']))
-            else:
-                TAGS_CMD.append('%s' % info['TRACKNUMBER'])
-        if info.has_key('DISC'):
-            TAGS_CMD.append('--disk')
-            if info.has_key('DISCTOTAL'):
-                TAGS_CMD.append('%s/%s' % (info['DISC'],info['DISCTOTAL']))
-            else:
-                TAGS_CMD.append('%s/1' % info['DISC'])
+
+        if encoder == 'ffmpeg':
+            run_pipeline(['flac', '-d', '-c', '-s', infile], [
+                'ffmpeg',
+                '-v','error',
+                '-f','wav',
+                '-i','pipe:0',
+                '-c:a','alac',
+            ] + ffmpeg_args(info) + [
+                '-f','ipod',
+                outfile
+            ])
         else:
-            TAGS_CMD.append('--disk')
-            TAGS_CMD.append('1/1')
-        if info.has_key('GENRE'):
-            TAGS_CMD.append('--genre')
-            TAGS_CMD.append('%s' % info['GENRE'])
-        if info.has_key('COPYRIGHT'):
-            TAGS_CMD.append('--copyright')
-            TAGS_CMD.append('%s' % info['COPYRIGHT'])
-        
-        TAGS_CMD.append('--overWrite')
-        
-        p = subprocess.Popen(TAGS_CMD,executable="AtomicParsley")
-        p.wait()
+            run(['flac', '-d', '-f', '-s', infile])
+            run([
+                'afconvert',
+                '-q','127',
+                '-f','m4af',
+                '-d','alac',
+                wavfile,
+                outfile
+            ])
+            run(['AtomicParsley', outfile, '--freefree'] +
+                atomicparsley_args(info) + ['--overWrite'])
+    except:
+        if os.path.exists(outfile):
+            os.unlink(outfile)
+        raise
+    finally:
+        if encoder != 'ffmpeg' and os.path.exists(wavfile):
+            os.unlink(wavfile)
+
+def convert(vbrq=DEFAULT_VBRQ, jobs=DEFAULT_JOBS, encoder=DEFAULT_ENCODER):
+    """
+    Converts every `*.flac` file in the current directory, `jobs` at a
+    time. Returns the list of `(file, error)` for those that failed.
+    """
+    if encoder == 'auto':
+        encoder = 'ffmpeg' if have_program('ffmpeg') else 'afconvert'
+    infiles = sorted(glob.glob('*.flac'))
+    print "Converting %d FLAC files to ALAC with %s, %d at a time..." % (
+        len(infiles), encoder, jobs)
+
+    todo = Queue()
+    for infile in infiles:
+        todo.put(infile)
+    failed = []
+    lock = Lock()
+
+    def work():
+        while True:
+            infile = todo.get()
+            if infile is None:
+                return
+            try:
+                convert_file(infile, vbrq, encoder)
+            except Exception, e:
+                with lock:
+                    failed.append((infile, e))
+                    print "FAILED %s: %s" % (infile, e)
+            else:
+                with lock:
+                    print "OK     %s" % infile
+            sys.stdout.flush()
+
+    threads = [Thread(target=work) for i in range(max(jobs, 1))]
+    for thread in threads:
+        todo.put(None)
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print
+    print "Converted %d of %d files." % (len(infiles) - len(failed),
+        len(infiles))
+    if failed:
+        print "Failed:"
+        for infile, e in sorted(failed):
+            print "  %s: %s" % (infile, e)
+    return failed
 
 def main(args):
+    jobs = DEFAULT_JOBS
+    encoder = DEFAULT_ENCODER
+    for arg in list(args):
+        if arg.startswith("--encoder="):
+            encoder = arg.split("=", 1)[1]
+            args.remove(arg)
+        elif arg.startswith("--jobs="):
+            jobs = int(arg.split("=", 1)[1])
+            args.remove(arg)
+        elif arg.startswith("-j") and arg[2:].isdigit():
+            jobs = int(arg[2:])
+            args.remove(arg)
+
     if len(args) == 1:
-        convert(args[0])
+        failed = convert(args[0], jobs, encoder)
     elif len(args) == 0:
-        convert()
+        failed = convert(jobs=jobs, encoder=encoder)
     else:
         print "Usage:"
-        print "convert [VBR quality, 0-127; default=%s]"%DEFAULT_VBRQ
+        print "convert [-jN|--jobs=N] [--encoder=ffmpeg|afconvert] [VBR quality, 0-127; default=%s]"%DEFAULT_VBRQ
+        print "    Converts N files at a time (default: %d)." % DEFAULT_JOBS
+        print "    The encoder defaults to ffmpeg if installed, else afconvert."
+        return
+    if failed:
+        sys.exit(1)
 
 if __name__ == '__main__':
     try:
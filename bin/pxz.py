@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+pxz.py
+
+Parallel `xz` compressor for pipelines: splits stdin into blocks, compresses
+them on several `xz` processes at once and writes the results to stdout, in
+order. Each block becomes its own .xz stream; a file of concatenated streams
+is a valid .xz file, so `xz -d` (or `pxz.py -d`, which just runs it)
+decompresses the output as usual.
+
+Copyright 2013, Mike Tigas
+https://mike.tig.as/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-----
+
+Requires XZ Utils.
+
+Usage:
+  pxz.py [-0 ... -9] [-e] [-j JOBS] [-b BLOCK_SIZE] < input > output.xz
+    Compresses with `xz -0` ... `xz -9` (default -6, "extreme" with -e), on
+    JOBS processes at once (default: one per CPU), in blocks of BLOCK_SIZE
+    bytes (a K, M or G suffix is allowed; default: three times the
+    dictionary size of the level, like `xz -T`).
+
+  pxz.py -d < input.xz > output
+
+Only a few blocks more than JOBS are held in memory: reading stops while the
+consumer of the output (e.g. `gpg` and `s3up` in `backup_dir.sh`) is behind,
+and resumes as it catches up. Compressing with -9 takes about 700MB of
+memory per job.
+"""
+import os
+import sys
+import traceback
+from errno import EPIPE
+from multiprocessing import cpu_count
+from Queue import Full, Queue
+from subprocess import PIPE, Popen
+from threading import Event, Thread
+
+XZ = 'xz'
+
+# Dictionary size of each `xz` preset level, in MB.
+DICT_SIZES = [0.25, 1, 2, 4, 4, 8, 8, 16, 32, 64]
+
+
+def parse_size(size):
+    """
+    Parses a size such as "500K", "2M" or "1G" into bytes.
+    """
+    size = size.strip().upper()
+    multiplier = 1
+    if size and size[-1] in "KMG":
+        multiplier = 1024 ** ("KMG".index(size[-1]) + 1)
+        size = size[:-1]
+    return int(float(size) * multiplier)
+
+
+def compress_block(data, options):
+    """
+    Compresses `data` into a complete .xz stream with `xz options`.
+    """
+    xz = Popen([XZ, '-z', '-c', '-q'] + options, stdin=PIPE, stdout=PIPE)
+    compressed = xz.communicate(data)[0]
+    if xz.returncode != 0:
+        raise IOError("%s exited with status %d" % (XZ, xz.returncode))
+    return compressed
+
+
+def read_blocks(fp, block_size):
+    """
+    Yields `fp` in `block_size` pieces (at least one, even if `fp` is empty,
+    so the output is always a valid .xz file).
+    """
+    data = fp.read(block_size)
+    yield data
+    while data:
+        data = fp.read(block_size)
+        if data:
+            yield data
+
+
+def compress_stream(src, dst, options, block_size, jobs):
+    """
+    Compresses `src` into `dst` with `jobs` `xz` processes at once.
+    """
+    todo = Queue()
+    # Blocks read but not yet written out; bounding this holds up reading
+    # when writing falls behind.
+    slots = Queue(maxsize=jobs * 2)
+    stop = Event()
+
+    def put(queue, item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def work():
+        while True:
+            slot = todo.get()
+            if slot is None:
+                return
+            try:
+                if not stop.is_set():
+                    slot['result'] = compress_block(slot['data'], options)
+            except Exception:
+                slot['error'] = sys.exc_info()
+            del slot['data']
+            slot['done'].set()
+
+    def feed():
+        try:
+            for data in read_blocks(src, block_size):
+                slot = {'data': data, 'done': Event()}
+                if not put(slots, slot):
+                    break
+                todo.put(slot)
+        except Exception:
+            slot = {'done': Event(), 'error': sys.exc_info()}
+            slot['done'].set()
+            put(slots, slot)
+        for i in range(jobs):
+            todo.put(None)
+        put(slots, None)
+
+    threads = [Thread(target=work) for i in range(jobs)]
+    threads.append(Thread(target=feed))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while True:
+            slot = slots.get()
+            if slot is None:
+                break
+            slot['done'].wait()
+            if 'error' in slot:
+                error = slot['error']
+                raise error[0], error[1], error[2]
+            dst.write(slot['result'])
+        dst.flush()
+    finally:
+        # Let the `xz` processes still running finish, and stop reading.
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+def main(args):
+    level = 6
+    extreme = False
+    jobs = cpu_count()
+    block_size = None
+    args = iter(args)
+    for arg in args:
+        if arg in ("-d", "--decompress"):
+            # Decompressing a stream can't be split up; let xz do it.
+            os.execvp(XZ, [XZ, '-d', '-c'])
+        elif arg in ("--help", "-h", "-?"):
+            print __doc__.split("-----")[1].strip()
+            return
+        elif arg == "-e":
+            extreme = True
+        elif arg == "-j":
+            jobs = int(next(args))
+        elif arg == "-b":
+            block_size = parse_size(next(args))
+        elif len(arg) == 2 and arg[0] == "-" and arg[1].isdigit():
+            level = int(arg[1])
+        else:
+            raise Exception("Unknown option %s" % arg)
+
+    options = ['-%d%s' % (level, 'e' if extreme else '')]
+    if block_size is None:
+        block_size = int(DICT_SIZES[level] * 3 * 1048576)
+    compress_stream(sys.stdin, sys.stdout, options, block_size, max(jobs, 1))
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+    except IOError, e:
+        if e.errno != EPIPE:
+            sys.stderr.write('\n')
+            traceback.print_exc(file=sys.stderr)
+            sys.stderr.write('\n')
+        sys.exit(1)
+    except Exception, e:
+        sys.stderr.write('\n')
+        traceback.print_exc(file=sys.stderr)
+        sys.stderr.write('\n')
+        sys.exit(1)
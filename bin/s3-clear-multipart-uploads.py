@@ -2,10 +2,33 @@
 # coding=utf-8
 # Run this if you have issues with `s3up.py` -- this will remove partially
 # uploaded file chunks and reset S3 state back to normal.
+# Relies on `s3client.py` and `s3up.py` in this directory.
+#
+# Usage:
+#   s3-clear-multipart-uploads.py [--dry-run] [--older-than=HOURS]
+#       [--prefix=PREFIX] [--include-journaled] [bucket]
+#
+# Aborts the multipart uploads in progress in `bucket` (default:
+# `AWS_DEFAULT_BUCKET`), ABORT_PARALLELIZATION at a time, and reports how
+# much stored part data that freed. Only uploads started more than HOURS
+# ago (default: any) under PREFIX are touched. Uploads that `s3up --resume`
+# has a journal for in JOURNAL_DIR are left alone unless
+# `--include-journaled` is given, since they can still be finished. With
+# `--dry-run`, only lists what would be aborted.
+#
+# To run this on a schedule against a busy bucket, give it an age that no
+# upload still being written can reach, e.g. `--older-than=24`.
 from __future__ import print_function
+import calendar
+import json
 import os
 import sys
-from boto.s3.connection import S3Connection
+import time
+import traceback
+import s3client
+import s3up
+from Queue import Full, Queue
+from threading import Thread
 
 AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID', '')
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY', '')
@@ -14,9 +37,16 @@ AWS_DEFAULT_BUCKET = os.environ.get('AWS_DEFAULT_BUCKET', '')
 
 S3_ENDPOINT = 's3.amazonaws.com'
 
+# Number of threads listing uploads at once, one "directory" each.
+LIST_PARALLELIZATION = 16
+
+# Number of uploads measured and aborted at once.
+ABORT_PARALLELIZATION = 16
+
 # Load/override options from optional `dotfiles_config.py` file.
 OPTIONS = set(['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY',
-    'AWS_DEFAULT_BUCKET', 'S3_ENDPOINT'])
+    'AWS_DEFAULT_BUCKET', 'S3_ENDPOINT', 'LIST_PARALLELIZATION',
+    'ABORT_PARALLELIZATION'])
 for option in OPTIONS:
     try:
         _cfg = __import__('dotfiles_config', globals(), locals(), [option,], -1)
@@ -37,12 +67,153 @@ if not (AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY):
     print("    %s" % configfile, file=sys.stderr)
     sys.exit(1)
 
-s3 = S3Connection(
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    host=S3_ENDPOINT
-)
-bucket = s3.get_bucket(AWS_DEFAULT_BUCKET)
-for mp in bucket.list_multipart_uploads():
-    print(mp.key_name)
-    mp.cancel_upload()
+_retry_policy = s3client.RetryPolicy(5)
+
+def initiated_at(mp):
+    """
+    When `mp` was started, as a Unix time.
+    """
+    return calendar.timegm(time.strptime(mp.initiated[:19],
+        '%Y-%m-%dT%H:%M:%S'))
+
+def journaled_upload_ids():
+    """
+    The IDs of the uploads that `s3up --resume` has journals for.
+    """
+    journal_dir = os.path.expanduser(s3up.JOURNAL_DIR)
+    upload_ids = set()
+    if not os.path.isdir(journal_dir):
+        return upload_ids
+    for filename in os.listdir(journal_dir):
+        try:
+            with open(os.path.join(journal_dir, filename), 'rb') as fp:
+                upload_id = json.loads(fp.readline()).get('upload_id')
+        except (IOError, ValueError, AttributeError):
+            continue
+        if upload_id:
+            upload_ids.add(upload_id)
+    return upload_ids
+
+def stored_bytes(mp):
+    """
+    The total size of the parts uploaded so far for `mp`.
+    """
+    return _retry_policy.call(lambda: sum(part.size for part in mp))
+
+def clear_upload(mp, dry_run=False):
+    """
+    Measures and (unless `dry_run`) aborts `mp`. Returns the bytes it held.
+    """
+    size = stored_bytes(mp)
+    if not dry_run:
+        _retry_policy.call(mp.cancel_upload)
+    return size
+
+def clear_uploads(uploads, dry_run=False, threads=ABORT_PARALLELIZATION):
+    """
+    Runs `clear_upload` on each of `uploads`, `threads` at a time, and
+    yields `(mp, size, error)` as each one finishes.
+    """
+    todo = Queue(maxsize=threads * 4)
+    results = Queue()
+
+    def work():
+        while True:
+            mp = todo.get()
+            if mp is None:
+                return
+            try:
+                results.put((mp, clear_upload(mp, dry_run), None))
+            except Exception, e:
+                results.put((mp, 0, e))
+
+    workers = [Thread(target=work) for i in range(threads)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+
+    pending = 0
+    for mp in uploads:
+        while True:
+            try:
+                todo.put(mp, timeout=0.1)
+                break
+            except Full:
+                # Report what's done meanwhile.
+                while not results.empty():
+                    pending -= 1
+                    yield results.get()
+        pending += 1
+    for thread in workers:
+        todo.put(None)
+    while pending:
+        pending -= 1
+        yield results.get()
+
+def main(args):
+    dry_run = False
+    older_than = 0
+    prefix = ''
+    include_journaled = False
+    for arg in list(args):
+        if arg in ("--help", "-h", "-?"):
+            print("s3-clear-multipart-uploads.py [--dry-run] [--older-than=HOURS]")
+            print("    [--prefix=PREFIX] [--include-journaled] [bucket]")
+            return
+        elif arg in ("--dry-run", "-n"):
+            dry_run = True
+        elif arg.startswith("--older-than="):
+            older_than = float(arg.split("=", 1)[1])
+        elif arg.startswith("--prefix="):
+            prefix = arg.split("=", 1)[1]
+        elif arg == "--include-journaled":
+            include_journaled = True
+        else:
+            continue
+        args.remove(arg)
+    bucket_name = args[0] if args else AWS_DEFAULT_BUCKET
+
+    bucket = s3client.get_bucket(bucket_name, AWS_ACCESS_KEY_ID,
+        AWS_SECRET_ACCESS_KEY, S3_ENDPOINT)
+    cutoff = time.time() - older_than * 3600
+    keep = set() if include_journaled else journaled_upload_ids()
+    skipped = [0]
+
+    def wanted(mp):
+        if mp.id in keep or initiated_at(mp) > cutoff:
+            skipped[0] += 1
+            return False
+        return True
+
+    uploads = s3client.list_multipart_uploads(bucket, prefix,
+        LIST_PARALLELIZATION)
+    uploads = (mp for mp in uploads if wanted(mp))
+
+    cleared = reclaimed = failed = 0
+    for mp, size, error in clear_uploads(uploads, dry_run,
+            ABORT_PARALLELIZATION):
+        if error is not None:
+            failed += 1
+            print("Failed to abort %s (%s): %s" % (mp.key_name, mp.id, error),
+                file=sys.stderr)
+            continue
+        cleared += 1
+        reclaimed += size
+        print("%s\t%s\t%s" % (mp.key_name, mp.initiated,
+            s3up.format_size(size)))
+        sys.stdout.flush()
+
+    print("%s %d uploads (%s of parts), skipped %d, %d failed." % (
+        "Would abort" if dry_run else "Aborted", cleared,
+        s3up.format_size(reclaimed), skipped[0], failed), file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+    except Exception, e:
+        sys.stderr.write('\n')
+        traceback.print_exc(file=sys.stderr)
+        sys.stderr.write('\n')
+        sys.exit(1)
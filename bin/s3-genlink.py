@@ -25,12 +25,23 @@ limitations under the License.
 -----
 
 Requires boto: http://boto.cloudhackers.com/
+Relies on `s3client.py` in this directory.
 
 Usage:
 s3-genlink.py remote_path [expiration_time]
     Given a key already in S3, generates a URL that is
     valid for `expiration_time` seconds. (Defaults to one hour.)
 
+s3-genlink.py [--expires=SECONDS] [--verify] remote_path [remote_path ...]
+s3-genlink.py [--expires=SECONDS] [--verify] -
+    Generates a URL for each of the given keys (or for each line read
+    from stdin, given `-`), one per line and in the same order.
+
+    URLs are signed locally, without talking to S3, so this doesn't check
+    that the keys exist. With `--verify`, every key is checked with a HEAD
+    request (VERIFY_PARALLELIZATION at a time) first; missing keys are
+    reported on stderr instead of getting a URL.
+
 
 Please set the following options below before using:
     AWS_ACCESS_KEY_ID (also accepted as an env var)
@@ -39,6 +50,7 @@ Please set the following options below before using:
     S3_ENDPOINT
     DEFAULT_EXPIRES
     FILENAME_HASHER
+    VERIFY_PARALLELIZATION
 (Note, you can also set these in `dotfiles_config.py` -- see example file.)
 """
 from __future__ import print_function
@@ -46,8 +58,11 @@ import hashlib
 import os
 import sys
 import traceback
-from boto.s3.connection import S3Connection
+import s3client
 from boto.s3.connection import OrdinaryCallingFormat
+from Queue import Queue
+from threading import Event, Thread
+from time import time
 
 AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID', '')
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY', '')
@@ -60,9 +75,13 @@ DEFAULT_EXPIRES = 3600
 
 FILENAME_HASHER = hashlib.sha224
 
+# Number of simultaneous HEAD requests made by `--verify`.
+VERIFY_PARALLELIZATION = 16
+
 # Load/override options from optional `dotfiles_config.py` file.
 OPTIONS = set(['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY',
-    'AWS_DEFAULT_BUCKET', 'S3_ENDPOINT', 'DEFAULT_EXPIRES', 'FILENAME_HASHER'])
+    'AWS_DEFAULT_BUCKET', 'S3_ENDPOINT', 'DEFAULT_EXPIRES', 'FILENAME_HASHER',
+    'VERIFY_PARALLELIZATION'])
 for option in OPTIONS:
     try:
         _cfg = __import__('dotfiles_config', globals(), locals(), [option,], -1)
@@ -83,31 +102,146 @@ if not (AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY):
     print("    %s" % configfile, file=sys.stderr)
     sys.exit(1)
 
-# ========== Uploader methods ==========
+# ========== Link methods ==========
 
-def key_to_secure_url(key, bucket=None, link_expires=DEFAULT_EXPIRES):
+def signed_url(key, bucket=None, expires=None):
+    """
+    Signs a GET URL for `key` in `bucket`, valid until the Unix time
+    `expires` (default: `DEFAULT_EXPIRES` seconds from now). This is a
+    local computation; no request is made.
+    """
     if not bucket:
         bucket = AWS_DEFAULT_BUCKET
+    if expires is None:
+        expires = int(time()) + DEFAULT_EXPIRES
 
-    s3 = S3Connection(
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        host=S3_ENDPOINT,
-        calling_format=OrdinaryCallingFormat()
-    )
-    bucket = s3.get_bucket(bucket)
-    k = bucket.get_key(key)
-    print(k.generate_url(expires_in=link_expires))
+    connection = s3client.get_connection(AWS_ACCESS_KEY_ID,
+        AWS_SECRET_ACCESS_KEY, S3_ENDPOINT, OrdinaryCallingFormat)
+    return connection.generate_url(expires, 'GET', bucket=bucket, key=key,
+        expires_in_absolute=True)
+
+def key_to_secure_url(key, bucket=None, link_expires=DEFAULT_EXPIRES):
+    print(signed_url(key, bucket, int(time()) + link_expires))
+
+_retry_policy = s3client.RetryPolicy(3)
+
+def key_exists(key, bucket=None):
+    """
+    Checks that `key` exists in `bucket` with a HEAD request.
+    """
+    bucket = s3client.get_bucket(bucket or AWS_DEFAULT_BUCKET,
+        AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, S3_ENDPOINT,
+        OrdinaryCallingFormat)
+    return _retry_policy.call(bucket.get_key, key) is not None
+
+def ordered_map(func, items, threads):
+    """
+    Like `itertools.imap`, but runs `func` on up to `threads` items at a
+    time. Results are yielded in the order of `items` as soon as they (and
+    all before them) are ready, and only a few items beyond the oldest
+    unfinished one are read ahead, so `items` can be an endless stream.
+    """
+    todo = Queue(maxsize=threads * 4)
+    results = Queue(maxsize=threads * 4)
+
+    def work():
+        while True:
+            slot = todo.get()
+            if slot is None:
+                return
+            try:
+                slot['result'] = func(slot['item'])
+            except Exception, e:
+                slot['error'] = e
+            slot['done'].set()
+
+    def feed():
+        for item in items:
+            slot = {'item': item, 'done': Event()}
+            results.put(slot)
+            todo.put(slot)
+        results.put(None)
+        for i in range(threads):
+            todo.put(None)
+
+    workers = [Thread(target=work) for i in range(threads)]
+    workers.append(Thread(target=feed))
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+
+    while True:
+        slot = results.get()
+        if slot is None:
+            return
+        slot['done'].wait()
+        if 'error' in slot:
+            raise slot['error']
+        yield slot['item'], slot['result']
+
+def batch_links(keys, bucket=None, link_expires=DEFAULT_EXPIRES, verify=False,
+        out=sys.stdout):
+    """
+    Writes a signed URL for each of `keys` to `out`, one per line, all
+    expiring at the same time. With `verify`, keys that don't exist are
+    reported on stderr instead. Returns the number of missing keys.
+    """
+    expires = int(time()) + link_expires
+    keys = (key.strip() for key in keys)
+    keys = (key for key in keys if key)
+    if verify:
+        checked = ordered_map(lambda key: key_exists(key, bucket), keys,
+            VERIFY_PARALLELIZATION)
+    else:
+        checked = ((key, True) for key in keys)
+
+    missing = 0
+    for key, exists in checked:
+        if exists:
+            out.write(signed_url(key, bucket, expires) + "\n")
+        else:
+            missing += 1
+            sys.stderr.write("Not found: %s\n" % key)
+    out.flush()
+    return missing
+
+def print_help():
+    print("s3-genlink.py remote_path [expiration_time]")
+    print("    Given a remote path already in S3, generates a URL that is")
+    print("    valid for `expiration_time` seconds. (Defaults to %s seconds.)" % DEFAULT_EXPIRES)
+    print()
+    print("s3-genlink.py [--expires=SECONDS] [--verify] remote_path [remote_path ...]")
+    print("s3-genlink.py [--expires=SECONDS] [--verify] -")
+    print("    Generates a URL for each remote path given (or read from stdin, one")
+    print("    per line, given `-`). URLs are signed locally; --verify checks that")
+    print("    the keys exist first.")
 
 def main(args):
-    if len(args) == 2:
+    link_expires = DEFAULT_EXPIRES
+    verify = False
+    options = False
+    for arg in list(args):
+        if arg == "--verify":
+            verify = options = True
+            args.remove(arg)
+        elif arg.startswith("--expires="):
+            link_expires = int(arg.split("=", 1)[1])
+            options = True
+            args.remove(arg)
+
+    if not args or args[0] in ("--help", "-h", "-?"):
+        print_help()
+    elif not options and len(args) == 2 and args[1].isdigit():
         key_to_secure_url(args[0], AWS_DEFAULT_BUCKET, int(args[1]))
-    elif len(args) == 1:
+    elif not options and len(args) == 1 and args[0] != "-":
         key_to_secure_url(args[0])
     else:
-        print("s3-genlink.py remote_path [expiration_time]")
-        print("    Given a remote path already in S3, generates a URL that is")
-        print("    valid for `expiration_time` seconds. (Defaults to %s seconds.)" % DEFAULT_EXPIRES)
+        if args == ["-"]:
+            keys = iter(sys.stdin.readline, '')
+        else:
+            keys = args
+        if batch_links(keys, AWS_DEFAULT_BUCKET, link_expires, verify):
+            sys.exit(1)
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,717 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+s3bench.py
+Benchmarks the S3 scripts in this directory against an in-process stand-in
+for S3, with injectable latency, bandwidth limits and failure rates. Nothing
+is sent over the network, so runs are reproducible and cheap -- use it to
+get numbers when tuning `CHUNK_SIZE`, `UPLOAD_PARALLELIZATION` and friends.
+
+Copyright 2010-2013, Mike Tigas
+https://mike.tig.as/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-----
+
+Requires boto: http://boto.cloudhackers.com/ (the scripts being benchmarked
+import it, but it is never used to make requests.)
+Relies on `s3up.py`, `s3up-dir.py`, `s3client.py`, `s3search.py` and
+`s3-clear-multipart-uploads.py` in this directory.
+
+Usage:
+  s3bench.py [options] [workload ...]
+
+Workloads (default: all of them, each in its own process so that peak
+memory use is measured separately):
+  single   One `--size` file through `s3up.upload_file`.
+  small    `--files` files of `--file-size` through `s3up-dir`.
+  huge     One sparse `--huge-size` file through `s3up.upload_file`.
+  listing  Lists `--keys` keys, spread over `--prefixes` "directories",
+           with `s3client.list_keys` (`--list-workers` threads).
+  search   Builds the `s3search` index of the same keys and searches it.
+  clear    Aborts `--uploads` multipart uploads in progress, spread over
+           `--prefixes` "directories", with `s3-clear-multipart-uploads`.
+  resume   Uploads a `--size` file with `--resume`, cut off halfway by a
+           simulated outage, and times the run that finishes it.
+
+Besides latency and bandwidth, the stand-in can inject connection resets
+(`--failure-rate`) and S3 throttling (`--request-limit`).
+
+Reports throughput, per-request latency percentiles (as seen by the
+stand-in, including simulated latency and transfer time), peak RSS and
+request counts for each workload. Run with `--help` for all options.
+"""
+from __future__ import print_function
+import argparse
+import hashlib
+import imp
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+from boto.exception import S3ResponseError
+from boto.s3.prefix import Prefix
+from bisect import bisect_left, bisect_right
+from collections import deque
+from errno import ECONNRESET
+from itertools import count
+from threading import Lock
+from time import gmtime, sleep, strftime, time
+
+BIN_DIR = os.path.abspath(os.path.dirname(__file__))
+
+# Amount of data the stand-in "receives" at a time.
+BLOCK_SIZE = 65536
+
+WORKLOADS = ('single', 'small', 'huge', 'listing', 'search', 'clear',
+    'resume')
+
+# ========== In-process S3 stand-in ==========
+
+class StandInS3(object):
+    """
+    Just enough of S3 (as seen through boto's `Bucket`, `Key` and
+    `MultiPartUpload` objects) for the S3 scripts to run against.
+
+    Every request waits `latency` seconds. Requests carrying data fail with
+    a connection reset with probability `failure_rate`, and are rejected
+    with 503 Slow Down beyond `request_limit` per second (0 for no limit),
+    like S3 does per prefix. Request bodies are read through a single
+    simulated link of `bandwidth` bytes/second shared by all connections (0
+    for unlimited). Once `outage_after` requests carrying data have been
+    made (if set), every further one is refused with a 403. Only sizes and
+    checksums are kept, never the data.
+    """
+    def __init__(self, latency=0.0, bandwidth=0, failure_rate=0.0,
+            request_limit=0, seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.request_limit = request_limit
+        self.outage_after = None
+        self.recent = deque()
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.link_free_at = 0.0
+        self.requests = {}
+        self.timings = {}
+        self.bytes_received = 0
+        self.buckets = {}
+
+    def request(self, op, can_fail=False):
+        """
+        Accounts for a request of type `op`, applying latency (and failures,
+        if `can_fail`). Returns the request's start time, for `finished`.
+        """
+        start = time()
+        with self.lock:
+            self.requests[op] = self.requests.get(op, 0) + 1
+            roll = self.random.random() if can_fail else 1.0
+            outage = can_fail and self.outage_after is not None and \
+                self.requests.get('PUT', 0) + \
+                self.requests.get('UploadPart', 0) > self.outage_after
+            throttle = False
+            if can_fail and self.request_limit:
+                while self.recent and self.recent[0] <= start - 1.0:
+                    self.recent.popleft()
+                throttle = len(self.recent) >= self.request_limit
+                if throttle:
+                    self.requests['throttled'] = \
+                        self.requests.get('throttled', 0) + 1
+                else:
+                    self.recent.append(start)
+        if self.latency:
+            sleep(self.latency)
+        if outage:
+            raise S3ResponseError(403, "Forbidden (injected)")
+        if roll < self.failure_rate:
+            raise socket.error(ECONNRESET, "Connection reset (injected)")
+        if throttle:
+            error = S3ResponseError(503, "Slow Down")
+            error.error_code = 'SlowDown'
+            raise error
+        return start
+
+    def finished(self, op, start):
+        with self.lock:
+            self.timings.setdefault(op, []).append(time() - start)
+
+    def receive(self, fp, size=None):
+        """
+        Reads a request body from `fp` at the simulated link speed. Returns
+        its MD5 and length.
+        """
+        md5 = hashlib.md5()
+        received = 0
+        while size is None or received < size:
+            want = BLOCK_SIZE if size is None else min(BLOCK_SIZE, size - received)
+            data = fp.read(want)
+            if not data:
+                break
+            md5.update(data)
+            received += len(data)
+            if self.bandwidth:
+                with self.lock:
+                    start = max(time(), self.link_free_at)
+                    self.link_free_at = start + float(len(data)) / self.bandwidth
+                    wait = self.link_free_at - time()
+                if wait > 0:
+                    sleep(wait)
+        with self.lock:
+            self.bytes_received += received
+        return md5, received
+
+    def get_bucket(self, bucket_name, *args, **kwargs):
+        with self.lock:
+            if bucket_name not in self.buckets:
+                self.buckets[bucket_name] = StandInBucket(self, bucket_name)
+            return self.buckets[bucket_name]
+
+
+class StandInKey(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.etag = None
+        self.size = 0
+        self.last_modified = None
+
+    def set_contents_from_file(self, fp, headers=None, policy=None,
+            encrypt_key=False, **kwargs):
+        s3 = self.bucket.s3
+        start = s3.request('PUT', can_fail=True)
+        md5, self.size = s3.receive(fp)
+        self.etag = '"%s"' % md5.hexdigest()
+        self.last_modified = time()
+        self.bucket.store(self)
+        s3.finished('PUT', start)
+
+    def set_contents_from_filename(self, filename, **kwargs):
+        with open(filename, 'rb') as fp:
+            self.set_contents_from_file(fp, **kwargs)
+
+
+class StandInPart(object):
+    def __init__(self, part_number, size, md5):
+        self.part_number = part_number
+        self.size = size
+        self.md5 = md5
+        self.etag = '"%s"' % md5.hexdigest()
+
+
+class StandInMultiPartUpload(object):
+    """
+    A multipart upload. Like boto's `MultiPartUpload`, it can also be made
+    with just a bucket and then pointed at an upload in progress by setting
+    its `key_name` and `id`, which is how `s3up --resume` picks one up.
+    """
+    _ids = count(1)
+
+    def __init__(self, bucket, key_name=None):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.id = None
+        self.initiated = strftime('%Y-%m-%dT%H:%M:%S.000Z', gmtime())
+        self.parts = {}
+
+    def _upload(self):
+        """
+        The upload this refers to, as stored in the bucket.
+        """
+        upload = self.bucket.uploads.get(self.id)
+        if upload is None:
+            error = S3ResponseError(404, "Not Found")
+            error.error_code = 'NoSuchUpload'
+            raise error
+        return upload
+
+    def upload_part_from_file(self, fp, part_num, headers=None, md5=None,
+            size=None, **kwargs):
+        s3 = self.bucket.s3
+        start = s3.request('UploadPart', can_fail=True)
+        upload = self._upload()
+        digest, received = s3.receive(fp, size)
+        part = StandInPart(part_num, received, digest)
+        with s3.lock:
+            upload.parts[part_num] = part
+        s3.finished('UploadPart', start)
+        return part
+
+    def get_all_parts(self, **kwargs):
+        start = self.bucket.s3.request('ListParts')
+        upload = self._upload()
+        parts = [upload.parts[n] for n in sorted(upload.parts)]
+        self.bucket.s3.finished('ListParts', start)
+        return parts
+
+    def __iter__(self):
+        return iter(self.get_all_parts())
+
+    def complete_upload(self):
+        s3 = self.bucket.s3
+        start = s3.request('CompleteMultipartUpload')
+        upload = self._upload()
+        parts = [upload.parts[n] for n in sorted(upload.parts)]
+        key = StandInKey(self.bucket, self.key_name)
+        key.size = sum(p.size for p in parts)
+        key.etag = '"%s-%d"' % (
+            hashlib.md5("".join(p.md5.digest() for p in parts)).hexdigest(),
+            len(parts)
+        )
+        key.last_modified = time()
+        self.bucket.store(key)
+        with s3.lock:
+            self.bucket.uploads.pop(self.id, None)
+        s3.finished('CompleteMultipartUpload', start)
+        return key
+
+    def cancel_upload(self):
+        start = self.bucket.s3.request('AbortMultipartUpload')
+        self._upload()
+        with self.bucket.s3.lock:
+            self.bucket.uploads.pop(self.id, None)
+        self.bucket.s3.finished('AbortMultipartUpload', start)
+
+
+class StandInBucket(object):
+    def __init__(self, s3, name):
+        self.s3 = s3
+        self.name = name
+        self.keys = {}
+        self.sorted_keys = None
+        self.uploads = {}
+
+    def store(self, key):
+        with self.s3.lock:
+            self.keys[key.name] = key
+            self.sorted_keys = None
+
+    def add_upload(self, key_name):
+        """
+        Starts a multipart upload of `key_name`, without a request.
+        """
+        upload = StandInMultiPartUpload(self, key_name)
+        upload.id = "standin-%d" % next(StandInMultiPartUpload._ids)
+        with self.s3.lock:
+            self.uploads[upload.id] = upload
+        return upload
+
+    def new_key(self, key_name):
+        return StandInKey(self, key_name)
+
+    def get_key(self, key_name, *args, **kwargs):
+        start = self.s3.request('HEAD')
+        key = self.keys.get(key_name)
+        self.s3.finished('HEAD', start)
+        return key
+
+    def initiate_multipart_upload(self, key_name, headers=None, policy=None,
+            encrypt_key=False, **kwargs):
+        start = self.s3.request('CreateMultipartUpload')
+        upload = self.add_upload(key_name)
+        self.s3.finished('CreateMultipartUpload', start)
+        return upload
+
+    def list_multipart_uploads(self, *args, **kwargs):
+        start = self.s3.request('ListMultipartUploads')
+        uploads = sorted(self.uploads.values(), key=lambda u: u.key_name)
+        self.s3.finished('ListMultipartUploads', start)
+        return uploads
+
+    def list(self, prefix='', delimiter='', marker='', *args, **kwargs):
+        # One LIST request per page of 1,000 keys, like the real thing.
+        while True:
+            page = self.get_all_keys(prefix=prefix, delimiter=delimiter,
+                marker=marker)
+            for item in page:
+                yield item
+            if not page.is_truncated:
+                return
+            marker = page.next_marker
+
+    def _page(self, op, names, entries, prefix, delimiter, marker,
+            max_keys=1000):
+        """
+        One LIST-style request: up to `max_keys` of `entries` (sorted by
+        `names`) after `marker`, rolled up into `Prefix`es at the first
+        `delimiter` past `prefix`.
+        """
+        start = self.s3.request(op)
+        page = StandInResultSet()
+        if delimiter and marker.endswith(delimiter):
+            # Resuming after a rolled-up prefix: skip everything under it.
+            i = bisect_left(names, marker[:-1] + chr(ord(delimiter) + 1))
+        elif marker >= prefix:
+            i = bisect_right(names, marker)
+        else:
+            i = bisect_left(names, prefix)
+        while i < len(names) and names[i].startswith(prefix):
+            if len(page) == max_keys:
+                page.is_truncated = True
+                break
+            name = names[i]
+            if delimiter and delimiter in name[len(prefix):]:
+                name = name[:name.index(delimiter, len(prefix)) + 1]
+                page.append(Prefix(self, name))
+                i = bisect_left(names, name[:-1] + chr(ord(delimiter) + 1))
+            else:
+                page.append(entries[i])
+                i += 1
+            page.next_marker = name
+        self.s3.finished(op, start)
+        return page
+
+    def get_all_keys(self, headers=None, prefix='', delimiter='', marker='',
+            **kwargs):
+        with self.s3.lock:
+            if self.sorted_keys is None:
+                names = sorted(self.keys)
+                self.sorted_keys = (names, [self.keys[n] for n in names])
+            names, keys = self.sorted_keys
+        return self._page('LIST', names, keys, prefix, delimiter, marker)
+
+    def get_all_multipart_uploads(self, headers=None, prefix='',
+            delimiter='', key_marker='', **kwargs):
+        with self.s3.lock:
+            uploads = sorted(self.uploads.values(), key=lambda u: u.key_name)
+        page = self._page('ListMultipartUploads',
+            [u.key_name for u in uploads], uploads, prefix, delimiter,
+            key_marker)
+        page.next_key_marker = page.next_marker
+        return page
+
+
+class StandInResultSet(list):
+    is_truncated = False
+    next_marker = None
+    next_key_marker = None
+    next_upload_id_marker = None
+
+
+# ========== Workloads ==========
+
+def make_file(path, size, sparse=False):
+    with open(path, 'wb') as fp:
+        if sparse:
+            fp.truncate(size)
+            return
+        block = os.urandom(min(size, 1048576)) if size else ''
+        written = 0
+        while written < size:
+            fp.write(block[:size - written])
+            written += len(block)
+
+
+def run_single(s3up, workdir, options, huge=False):
+    path = os.path.join(workdir, 'huge.bin' if huge else 'single.bin')
+    size = options.huge_size if huge else options.size
+    make_file(path, size, sparse=huge)
+    start = time()
+    s3up.upload_file(path, 'bench', 'bench/' + os.path.basename(path))
+    return size, time() - start
+
+
+def run_small(s3up, workdir, options):
+    s3up_dir = imp.load_source('s3up_dir', os.path.join(BIN_DIR, 's3up-dir.py'))
+    local_dir = os.path.join(workdir, 'small')
+    for i in range(options.files):
+        subdir = os.path.join(local_dir, "%03d" % (i % 100))
+        if not os.path.isdir(subdir):
+            os.makedirs(subdir)
+        make_file(os.path.join(subdir, "%06d.txt" % i), options.file_size)
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time()
+        s3up_dir.upload_dir(local_dir, 'bench', 'bench')
+        elapsed = time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return options.files * options.file_size, elapsed
+
+
+def run_listing(s3up, workdir, options):
+    import s3client
+    bucket = s3client.get_bucket('bench', None, None, None)
+    for i in range(options.keys):
+        bucket.store(bucket.new_key(
+            "listing/%04d/%08d" % (i % options.prefixes, i)))
+    start = time()
+    listed = sum(1 for key in s3client.list_keys(bucket, 'listing/',
+        options.list_workers))
+    elapsed = time() - start
+    assert listed == options.keys, (listed, options.keys)
+    return listed, elapsed
+
+
+def run_search(s3up, workdir, options):
+    import s3client
+    s3search = imp.load_source('s3search', os.path.join(BIN_DIR, 's3search.py'))
+    s3search.INDEX_DIR = os.path.join(workdir, 'index')
+    s3up.LIST_PARALLELIZATION = options.list_workers
+    bucket = s3client.get_bucket('bench', None, None, None)
+    for i in range(options.keys):
+        bucket.store(bucket.new_key("%04d/%08d" % (i % options.prefixes, i)))
+    start = time()
+    index = s3search.KeyIndex('bench')
+    index.refresh(bucket)
+    matches = sum(1 for match in index.search(['/0000']))
+    elapsed = time() - start
+    assert matches == min(options.keys, 10000), matches
+    return options.keys, elapsed
+
+
+def run_clear(s3up, workdir, options):
+    import s3client
+    s3up.JOURNAL_DIR = os.path.join(workdir, 'journal')
+    clear = imp.load_source('s3_clear_multipart_uploads',
+        os.path.join(BIN_DIR, 's3-clear-multipart-uploads.py'))
+    clear.LIST_PARALLELIZATION = options.list_workers
+    bucket = s3client.get_bucket('bench', None, None, None)
+    for i in range(options.uploads):
+        upload = bucket.add_upload("%04d/%08d" % (i % options.prefixes, i))
+        upload.parts[1] = StandInPart(1, 5242880, hashlib.md5())
+
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = open(os.devnull, 'w')
+    try:
+        start = time()
+        clear.main(['bench'])
+        elapsed = time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout, sys.stderr = stdout, stderr
+    assert not bucket.uploads, len(bucket.uploads)
+    return options.uploads, elapsed
+
+
+def run_resume(s3up, workdir, options):
+    import s3client
+    path = os.path.join(workdir, 'resume.bin')
+    make_file(path, options.size)
+    s3up.JOURNAL_DIR = os.path.join(workdir, 'journal')
+    s3up.MultiPartUpload = StandInMultiPartUpload
+    s3 = s3client.get_bucket('bench', None, None, None).s3
+
+    # Cut the first run off halfway through its parts.
+    s3.outage_after = s3up.chunk_layout(options.size)[1] // 2
+    try:
+        s3up.upload_file(path, 'bench', 'bench/resume.bin', resume=True)
+    except Exception:
+        pass
+    else:
+        raise AssertionError("The simulated outage didn't stop the upload.")
+    s3.outage_after = None
+
+    # Only the run that finishes the upload is measured.
+    with s3.lock:
+        s3.requests.clear()
+        s3.timings.clear()
+    start = time()
+    s3up.upload_file(path, 'bench', 'bench/resume.bin', resume=True)
+    return options.size, time() - start
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100.0), len(values) - 1)]
+
+
+def peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X bytes.
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def run_workload(workload, options):
+    """
+    Runs `workload` in this process and returns its results as a dict.
+    """
+    # The scripts refuse to load without credentials; the stand-in doesn't
+    # care what they are.
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    sys.path.insert(0, BIN_DIR)
+    import s3client
+    import s3up
+
+    s3 = StandInS3(options.latency, options.bandwidth, options.failure_rate,
+        options.request_limit, options.seed)
+    s3client.get_bucket = s3.get_bucket
+    if options.chunk_size:
+        s3up.CHUNK_SIZE = options.chunk_size
+        s3up.MULTIPART_THRESHOLD = options.chunk_size
+    if options.parallelization:
+        s3up.UPLOAD_PARALLELIZATION = options.parallelization
+        s3up.DIR_UPLOAD_PARALLELIZATION = options.parallelization
+    if options.adaptive:
+        s3up.ADAPTIVE_UPLOAD = True
+
+    workdir = tempfile.mkdtemp(prefix='s3bench-')
+    try:
+        if workload == 'small':
+            nbytes, elapsed = run_small(s3up, workdir, options)
+        elif workload == 'listing':
+            nbytes, elapsed = run_listing(s3up, workdir, options)
+        elif workload == 'search':
+            nbytes, elapsed = run_search(s3up, workdir, options)
+        elif workload == 'clear':
+            nbytes, elapsed = run_clear(s3up, workdir, options)
+        elif workload == 'resume':
+            nbytes, elapsed = run_resume(s3up, workdir, options)
+        else:
+            nbytes, elapsed = run_single(s3up, workdir, options,
+                huge=(workload == 'huge'))
+    finally:
+        shutil.rmtree(workdir)
+
+    latencies = []
+    for op in ('PUT', 'UploadPart', 'LIST', 'ListMultipartUploads',
+            'ListParts', 'AbortMultipartUpload'):
+        latencies.extend(s3.timings.get(op, []))
+    if workload in ('listing', 'search'):
+        unit = 'keys'
+    elif workload == 'clear':
+        unit = 'uploads'
+    else:
+        unit = 'bytes'
+    return {
+        'workload': workload,
+        'unit': unit,
+        'bytes': nbytes,
+        'seconds': elapsed,
+        'throughput': nbytes / max(elapsed, 0.000001),
+        'latency_p50': percentile(latencies, 50),
+        'latency_p90': percentile(latencies, 90),
+        'latency_p99': percentile(latencies, 99),
+        'peak_rss': peak_rss(),
+        'requests': s3.requests,
+        'total_requests': sum(s3.requests.values()),
+    }
+
+
+def human_bytes(n):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n) < 1024.0:
+            return "%.1f%s" % (n, unit)
+        n /= 1024.0
+    return "%.1fTB" % n
+
+
+def print_result(result):
+    print("%s:" % result['workload'])
+    unit = result.get('unit', 'bytes')
+    if unit != 'bytes':
+        print("  %d %s in %.2fs = %d %s/s" % (result['bytes'], unit,
+            result['seconds'], result['throughput'], unit))
+    else:
+        print("  %s in %.2fs = %s/s" % (human_bytes(result['bytes']),
+            result['seconds'], human_bytes(result['throughput'])))
+    print("  request latency: p50 %.3fs  p90 %.3fs  p99 %.3fs" % (
+        result['latency_p50'], result['latency_p90'], result['latency_p99']))
+    print("  peak RSS: %s" % human_bytes(result['peak_rss']))
+    print("  requests: %d (%s)" % (result['total_requests'], ", ".join(
+        "%s %d" % (op, n) for op, n in sorted(result['requests'].items()))))
+    print()
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the S3 scripts against an in-process S3 stand-in.")
+    parser.add_argument('workloads', nargs='*', metavar='workload',
+        help="one or more of: %s (default: all)" % ", ".join(WORKLOADS))
+    parser.add_argument('--latency', type=float, default=0.02,
+        help="seconds added to every request (default: %(default)s)")
+    parser.add_argument('--bandwidth', type=float, default=0,
+        help="bytes/second of the simulated link, shared by all "
+        "connections; 0 for unlimited (default)")
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+        help="probability (0-1) of a PUT or UploadPart request failing "
+        "with a connection reset (default: %(default)s)")
+    parser.add_argument('--request-limit', type=int, default=0,
+        help="PUT and UploadPart requests allowed per second before the "
+        "stand-in answers 503 Slow Down; 0 for no limit "
+        "(default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=None,
+        help="random seed for injected failures")
+    parser.add_argument('--size', type=int, default=268435456,
+        help="size of the `single` and `resume` files (default: 256MB)")
+    parser.add_argument('--files', type=int, default=2000,
+        help="number of files for `small` (default: %(default)s)")
+    parser.add_argument('--file-size', type=int, default=4096,
+        help="size of each `small` file (default: %(default)s)")
+    parser.add_argument('--huge-size', type=int, default=4294967296,
+        help="size of the (sparse) `huge` file (default: 4GB)")
+    parser.add_argument('--keys', type=int, default=100000,
+        help="number of keys for `listing` and `search` "
+        "(default: %(default)s)")
+    parser.add_argument('--prefixes', type=int, default=100,
+        help="number of \"directories\" the keys (or uploads) are spread "
+        "over (default: %(default)s)")
+    parser.add_argument('--list-workers', type=int, default=16,
+        help="listing threads for `listing`, `search` and `clear` "
+        "(default: %(default)s)")
+    parser.add_argument('--uploads', type=int, default=10000,
+        help="number of multipart uploads for `clear` "
+        "(default: %(default)s)")
+    parser.add_argument('--chunk-size', type=int, default=None,
+        help="override CHUNK_SIZE (and MULTIPART_THRESHOLD)")
+    parser.add_argument('--parallelization', type=int, default=None,
+        help="override UPLOAD_PARALLELIZATION (and "
+        "DIR_UPLOAD_PARALLELIZATION)")
+    parser.add_argument('--adaptive', action='store_true',
+        help="enable ADAPTIVE_UPLOAD")
+    parser.add_argument('--json', action='store_true',
+        help="print results as JSON lines")
+    parser.add_argument('--in-process', action='store_true',
+        help=argparse.SUPPRESS)
+    options = parser.parse_args(args)
+    for workload in options.workloads:
+        if workload not in WORKLOADS:
+            parser.error("unknown workload: %s" % workload)
+    return options
+
+
+def main(args):
+    options = parse_args(args)
+    workloads = options.workloads or WORKLOADS
+
+    for workload in workloads:
+        if options.in_process:
+            result = run_workload(workload, options)
+        else:
+            # Each workload gets a fresh process, for a meaningful peak RSS.
+            child_args = [a for a in args if a not in WORKLOADS]
+            output = subprocess.check_output([sys.executable,
+                os.path.abspath(__file__), '--in-process', '--json', workload]
+                + child_args)
+            result = json.loads(output.splitlines()[-1])
+
+        if options.json:
+            print(json.dumps(result))
+            sys.stdout.flush()
+        else:
+            print_result(result)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,403 @@
+# coding=utf-8
+"""
+s3client.py
+Shared S3 connection handling for the S3 scripts in this directory
+(`s3up`, `s3up-dir`, `s3up-private`, `s3-genlink`, `s3search`,
+`s3-clear-multipart-uploads`).
+
+Copyright 2010-2013, Mike Tigas
+https://mike.tig.as/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-----
+
+Requires boto: http://boto.cloudhackers.com/
+
+Every `S3Connection` keeps its own pool of keep-alive HTTP(S) connections,
+so creating a fresh one for each file (or each call) means a new TCP and
+TLS handshake every time. Instead, `get_connection` hands out one shared
+connection per set of credentials/endpoint for the life of the process, and
+`get_bucket` caches bucket handles on top of that without the extra
+validation request `S3Connection.get_bucket` makes by default.
+
+`RetryPolicy` decides whether and when failed requests are retried, and
+paces requests from all the threads sharing it when S3 asks us to slow down.
+
+`list_keys` and `list_multipart_uploads` list large buckets concurrently,
+one "directory" per thread.
+"""
+import boto
+import errno
+import random
+import socket
+import sys
+from Queue import Full, Queue
+from boto.exception import BotoServerError
+from boto.s3.connection import S3Connection
+from boto.s3.prefix import Prefix
+from httplib import HTTPException
+from threading import Event, Lock, Thread
+from time import sleep, time
+
+_lock = Lock()
+_connections = {}
+_buckets = {}
+
+
+def get_connection(aws_access_key_id, aws_secret_access_key, host,
+        calling_format=None, port=None, is_secure=True):
+    """
+    Returns the shared `S3Connection` for the given credentials and `host`
+    (and `port`, by default 443, or 80 without `is_secure`).
+    `calling_format` is a boto calling format class (not an instance), e.g.
+    `OrdinaryCallingFormat`.
+
+    boto's own retries are turned off (including a `num_retries` set in the
+    boto config, which would take precedence): it retries a SlowDown up to
+    six more times, with its own backoff, inside what `RetryPolicy` sees as
+    a single attempt. `RetryPolicy` is the only retry layer.
+    """
+    cache_key = (aws_access_key_id, aws_secret_access_key, host,
+        calling_format, port, is_secure)
+    with _lock:
+        connection = _connections.get(cache_key)
+        if connection is None:
+            if not boto.config.has_section('Boto'):
+                boto.config.add_section('Boto')
+            boto.config.set('Boto', 'num_retries', '0')
+            kwargs = {}
+            if calling_format:
+                kwargs['calling_format'] = calling_format()
+            connection = S3Connection(
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                host=host,
+                port=port,
+                is_secure=is_secure,
+                **kwargs
+            )
+            connection.num_retries = 0
+            _connections[cache_key] = connection
+    return connection
+
+
+def get_bucket(bucket_name, aws_access_key_id, aws_secret_access_key, host,
+        calling_format=None):
+    """
+    Returns a cached handle for `bucket_name` on the shared connection. The
+    bucket isn't validated up front; a missing bucket shows up as an error
+    on the first request made against it instead.
+    """
+    cache_key = (bucket_name, aws_access_key_id, aws_secret_access_key, host,
+        calling_format)
+    with _lock:
+        bucket = _buckets.get(cache_key)
+    if bucket is None:
+        connection = get_connection(aws_access_key_id, aws_secret_access_key,
+            host, calling_format)
+        bucket = connection.get_bucket(bucket_name, validate=False)
+        with _lock:
+            bucket = _buckets.setdefault(cache_key, bucket)
+    return bucket
+
+
+# ========== Retry policy ==========
+
+# How `classify_error` sorts failed requests.
+THROTTLED = 'throttled'  # S3 wants us to slow down: back off, retry.
+TRANSIENT = 'transient'  # Network trouble or a server error: retry.
+FATAL = 'fatal'          # Will fail the same way every time: give up.
+
+THROTTLE_CODES = set(['SlowDown', 'Throttling', 'ThrottlingException',
+    'RequestLimitExceeded', 'TooManyRequests'])
+TRANSIENT_CODES = set(['RequestTimeout', 'InternalError', 'BadDigest',
+    'IncompleteBody', 'ServiceUnavailable', 'OperationAborted'])
+FATAL_ERRNOS = set([errno.ENOENT, errno.EACCES, errno.EISDIR, errno.EPERM])
+
+
+def classify_error(exc):
+    """
+    Sorts an exception raised by a request into `THROTTLED`, `TRANSIENT` or
+    `FATAL`. Anything unrecognized is treated as transient.
+    """
+    if isinstance(exc, BotoServerError):
+        code = getattr(exc, 'error_code', None)
+        if exc.status == 503 or code in THROTTLE_CODES:
+            return THROTTLED
+        if exc.status >= 500 or code in TRANSIENT_CODES:
+            return TRANSIENT
+        # Bad credentials, missing permissions, missing bucket or upload...
+        return FATAL
+    if isinstance(exc, (socket.error, HTTPException)):
+        return TRANSIENT
+    if isinstance(exc, (IOError, OSError)) and exc.errno in FATAL_ERRNOS:
+        # A local file we can't read.
+        return FATAL
+    return TRANSIENT
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket handing out `rate` tokens per second, with up
+    to `capacity` (default: one second's worth) saved up for bursts. A
+    `rate` of None means unlimited.
+    """
+    def __init__(self, rate=None, capacity=None):
+        self.lock = Lock()
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = 0.0
+        self.updated = time()
+
+    def set_rate(self, rate, capacity=None):
+        with self.lock:
+            self._refill()
+            self.rate = rate
+            self.capacity = capacity
+
+    def _refill(self):
+        now = time()
+        if self.rate:
+            capacity = self.capacity or self.rate
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate,
+                capacity)
+        self.updated = now
+
+    def consume(self, tokens=1):
+        """
+        Takes `tokens` from the bucket, sleeping until they are available.
+        Waiting callers queue up behind each other (the balance can go
+        negative), so consumption is spread evenly instead of in bursts.
+        """
+        with self.lock:
+            if not self.rate:
+                return
+            self._refill()
+            self.tokens -= tokens
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            sleep(wait)
+
+
+class RetryPolicy(object):
+    """
+    Runs requests for any number of threads, retrying failures according to
+    `classify_error`:
+
+    * Fatal errors (e.g. 403 Forbidden) are raised right away.
+    * Anything else is retried up to `max_attempts` attempts in total, after
+      a "decorrelated jitter" delay between `base_delay` and `max_delay`
+      seconds, so that threads failing together don't retry in lockstep.
+    * When S3 throttles us, the shared request rate is halved (starting
+      from the rate we were going at), and then grows back by `RECOVERY`
+      requests/second every second while requests succeed. Throttles
+      arriving together (many workers hit by the same SlowDown) only halve
+      the rate once.
+    """
+    MIN_RATE = 1.0
+    RECOVERY = 5.0
+
+    def __init__(self, max_attempts, base_delay=0.5, max_delay=30.0):
+        self.max_attempts = max(max_attempts, 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limiter = TokenBucket()
+        self.lock = Lock()
+        self.retries = 0
+        self.throttles = 0
+        self.window_start = time()
+        self.window_requests = 0
+        self.recent_rate = None
+        self.last_cut = 0.0
+
+    def _count_request(self):
+        with self.lock:
+            self.window_requests += 1
+            elapsed = time() - self.window_start
+            if elapsed >= 1.0:
+                self.recent_rate = self.window_requests / elapsed
+                self.window_start = time()
+                self.window_requests = 0
+
+    def _throttled(self):
+        with self.lock:
+            self.throttles += 1
+            if time() - self.last_cut < 1.0:
+                return
+            self.last_cut = time()
+            rate = self.limiter.rate or self.recent_rate or self.MIN_RATE * 2
+            self.limiter.set_rate(max(rate / 2.0, self.MIN_RATE))
+
+    def _succeeded(self):
+        rate = self.limiter.rate
+        if rate:
+            self.limiter.set_rate(rate + self.RECOVERY / rate)
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls `func(*args, **kwargs)`, retrying as described above. Returns
+        its result, or raises its last error.
+        """
+        attempts = 0
+        delay = self.base_delay
+        while True:
+            self.limiter.consume()
+            self._count_request()
+            try:
+                result = func(*args, **kwargs)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception, e:
+                kind = classify_error(e)
+                attempts += 1
+                if kind == FATAL or attempts >= self.max_attempts:
+                    raise
+                if kind == THROTTLED:
+                    self._throttled()
+                with self.lock:
+                    self.retries += 1
+                delay = min(self.max_delay,
+                    random.uniform(self.base_delay, delay * 3))
+                sleep(delay)
+            else:
+                self._succeeded()
+                return result
+
+
+# ========== Listing ==========
+
+_listing_retries = RetryPolicy(5)
+
+
+def key_pages(bucket, prefix, delimiter):
+    """
+    Yields the pages (of up to 1,000 entries) of a listing of the keys in
+    `bucket` under `prefix`: `Key`s, plus a `Prefix` for every "directory"
+    one `delimiter` further down.
+    """
+    params = {'prefix': prefix, 'delimiter': delimiter}
+    while True:
+        page = _listing_retries.call(bucket.get_all_keys, **params)
+        yield page
+        if not page.is_truncated or not len(page):
+            return
+        params['marker'] = page.next_marker or page[-1].name
+
+
+def upload_pages(bucket, prefix, delimiter):
+    """
+    Like `key_pages`, for the multipart uploads in progress in `bucket`
+    (`MultiPartUpload`s and `Prefix`es).
+    """
+    params = {'prefix': prefix, 'delimiter': delimiter}
+    while True:
+        page = _listing_retries.call(bucket.get_all_multipart_uploads,
+            **params)
+        yield page
+        if not page.is_truncated or not len(page):
+            return
+        params['key_marker'] = page.next_key_marker
+        params['upload_id_marker'] = page.next_upload_id_marker
+
+
+def parallel_listing(bucket, pages, prefix='', delimiter='/', workers=8):
+    """
+    Lists everything under `prefix` in `bucket` with `pages` (`key_pages` or
+    `upload_pages`), on `workers` threads at once. Each thread lists one
+    level of one prefix, yields the entries there and hands the prefixes
+    one `delimiter` down to the other threads, so the listing is spread
+    over however many "directories" the bucket has rather than paged
+    through 1,000 entries at a time.
+
+    This is a generator: entries come out (in no particular order) while
+    the listing is still running, and closing it stops the listing.
+    """
+    todo = Queue()
+    results = Queue(maxsize=workers * 4)
+    stop = Event()
+    lock = Lock()
+    outstanding = [1]
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def work():
+        while True:
+            prefix = todo.get()
+            if prefix is None or stop.is_set():
+                return
+            try:
+                for page in pages(bucket, prefix, delimiter):
+                    if stop.is_set():
+                        break
+                    entries = []
+                    for entry in page:
+                        if isinstance(entry, Prefix):
+                            with lock:
+                                outstanding[0] += 1
+                            todo.put(entry.name)
+                        else:
+                            entries.append(entry)
+                    put(entries)
+            except Exception:
+                put(sys.exc_info())
+            with lock:
+                outstanding[0] -= 1
+                last = not outstanding[0]
+            if last:
+                put(done)
+
+    threads = [Thread(target=work) for i in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    todo.put(prefix)
+
+    try:
+        while True:
+            entries = results.get()
+            if entries is done:
+                return
+            if isinstance(entries, tuple):
+                raise entries[0], entries[1], entries[2]
+            for entry in entries:
+                yield entry
+    finally:
+        stop.set()
+        for thread in threads:
+            todo.put(None)
+        # At most one request per thread is still in flight.
+        for thread in threads:
+            thread.join()
+
+
+def list_keys(bucket, prefix='', workers=8):
+    """
+    Yields every key in `bucket` under `prefix`; see `parallel_listing`.
+    """
+    return parallel_listing(bucket, key_pages, prefix, '/', workers)
+
+
+def list_multipart_uploads(bucket, prefix='', workers=8):
+    """
+    Yields every multipart upload in progress in `bucket` under `prefix`;
+    see `parallel_listing`.
+    """
+    return parallel_listing(bucket, upload_pages, prefix, '/', workers)
@@ -0,0 +1,599 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+s3dedup.py
+
+Incremental, deduplicated directory backups to S3. Files are split into
+content-defined chunks, and only chunks that aren't in the bucket yet are
+uploaded, along with a small manifest listing the files of the snapshot and
+their chunks. A nightly backup of a mostly unchanged directory uploads (and
+reads) little more than what changed since the last one.
+
+Copyright 2013, Mike Tigas
+https://mike.tig.as/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-----
+
+Requires boto: http://boto.cloudhackers.com/
+Relies on `s3up.py` in this directory.
+
+Usage:
+  s3dedup backup [--bucket=bucket] local_directory [name]
+    Backs up `local_directory` as a new snapshot of `name` (default: the
+    directory's name).
+
+  s3dedup list [--bucket=bucket] [name]
+    Lists the snapshots of `name`, or the names backed up.
+
+  s3dedup restore [--bucket=bucket] name local_directory [snapshot]
+    Restores the latest (or the given) snapshot of `name` into
+    `local_directory`.
+
+  s3dedup reindex [--bucket=bucket]
+    Rebuilds the local chunk index from a listing of the bucket.
+
+Everything is stored under `DEDUP_PREFIX` in the bucket (default:
+AWS_DEFAULT_BUCKET):
+    chunks/ab/abcdef...          one object per chunk, named by its SHA-256
+    manifests/name/YYYYMMDD-HHMMSS.json.gz
+                                 one object per snapshot
+
+Chunk boundaries are found with a "gear" rolling hash, so they depend on
+the content around them rather than on offsets: inserting or removing data
+only changes the chunks around the edit, not every chunk after it. Chunks
+are between `MIN_CHUNK_SIZE` and `MAX_CHUNK_SIZE` bytes, about
+`MIN_CHUNK_SIZE + AVG_CHUNK_SIZE` on average, and zlib-compressed when
+that makes them smaller. Hashing is slow in Python, so the changed files
+are scanned for boundaries in `SCAN_BLOCK_SIZE` blocks on `SCAN_PROCESSES`
+processes at once, while the main process reads and hashes the chunks
+found so far and the upload threads compress and upload them.
+
+Which chunks are already in the bucket is kept in a local index (see
+`INDEX_DIR`), along with the size, mtime and chunks of every file backed
+up; files that haven't changed since aren't read again. The index is
+built from a listing of the bucket the first time it's used, and can be
+rebuilt with `reindex` (e.g. if chunks were deleted from the bucket).
+
+Unlike `backup_dir.sh`, which encrypts archives with GPG, chunks and
+manifests are protected by a private ACL and encrypted at rest by S3
+(SSE-S3), like `s3up-private` uploads.
+
+Before using, please configure at least the following options in `s3up.py`:
+    AWS_ACCESS_KEY_ID
+    AWS_SECRET_ACCESS_KEY
+    AWS_DEFAULT_BUCKET
+    S3_ENDPOINT
+(Note, you can also set these in `dotfiles_config.py` -- see example file.)
+"""
+from __future__ import print_function
+import base64
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import stat
+import sys
+import traceback
+import zlib
+from datetime import datetime
+from itertools import imap
+from multiprocessing import Pool, cpu_count
+from StringIO import StringIO
+from threading import Lock
+from time import time
+
+import s3client
+import s3up
+
+# Where backups are stored in the bucket.
+DEDUP_PREFIX = 'dedup/'
+
+# Where the local index of each bucket's chunks (and backed up files) is
+# kept.
+INDEX_DIR = '~/.s3up/dedup'
+
+# Chunk size bounds; see above. `AVG_CHUNK_SIZE` must be a power of two.
+MIN_CHUNK_SIZE = 262144
+AVG_CHUNK_SIZE = 1048576
+MAX_CHUNK_SIZE = 4194304
+
+# Number of simultaneous chunk uploads (or downloads, when restoring).
+DEDUP_PARALLELIZATION = s3up.DIR_UPLOAD_PARALLELIZATION
+
+# Number of processes scanning files for chunk boundaries, and how many
+# bytes each scans at a time.
+SCAN_PROCESSES = cpu_count()
+SCAN_BLOCK_SIZE = 16777216
+
+
+# ========== Content-defined chunking ==========
+
+# A fixed pseudo-random 32-bit value for every byte value. Changing these
+# (or the chunk sizes) moves every chunk boundary, so nothing already backed
+# up would be reused.
+GEAR = [int(hashlib.md5(chr(i)).hexdigest()[:8], 16) for i in range(256)]
+
+# In the gear hash, bit `n` only depends on the last `n + 1` bytes, so
+# boundaries are picked on the top bits, which depend on the last 32 bytes
+# only: a block of a file can be scanned without hashing what comes before.
+_mask_bits = AVG_CHUNK_SIZE.bit_length() - 1
+BOUNDARY_MASK = ((1 << _mask_bits) - 1) << (32 - _mask_bits)
+WINDOW_SIZE = 32
+
+
+def find_boundaries(block):
+    """
+    Returns the offsets of the chunk boundary candidates (the positions
+    after a byte at which the hash of the `WINDOW_SIZE` bytes up to it
+    picks a boundary) in `block`, a `(path, offset, length)` range of a
+    file. Runs in the `SCAN_PROCESSES` worker processes.
+    """
+    path, offset, length = block
+    warm_up = min(offset, WINDOW_SIZE - 1)
+    with open(path, 'rb') as fp:
+        fp.seek(offset - warm_up)
+        data = fp.read(length + warm_up)
+    h = 0
+    gear = GEAR
+    mask = BOUNDARY_MASK
+    i = offset - warm_up
+    boundaries = []
+    for b in bytearray(data):
+        h = ((h << 1) + gear[b]) & 0xFFFFFFFF
+        i += 1
+        if not h & mask and i > offset:
+            boundaries.append(i)
+    return boundaries
+
+
+def scan_blocks(size):
+    """
+    The `(offset, length)` blocks `find_boundaries` scans a file of `size`
+    bytes in. Files that fit in a minimal chunk aren't scanned at all.
+    """
+    if size <= MIN_CHUNK_SIZE:
+        return []
+    return [(offset, min(SCAN_BLOCK_SIZE, size - offset))
+        for offset in range(0, size, SCAN_BLOCK_SIZE)]
+
+
+def chunk_file(fp, boundaries):
+    """
+    Splits the file `fp` into chunks, yielding their data. A chunk ends at
+    the first of `boundaries` (as found by `find_boundaries`, in order)
+    more than `MIN_CHUNK_SIZE` bytes in, or after `MAX_CHUNK_SIZE` bytes.
+    """
+    boundaries = iter(boundaries)
+    boundary = next(boundaries, None)
+    start = 0
+    while True:
+        while boundary is not None and boundary <= start + MIN_CHUNK_SIZE:
+            boundary = next(boundaries, None)
+        if boundary is not None and boundary <= start + MAX_CHUNK_SIZE:
+            data = fp.read(boundary - start)
+        else:
+            data = fp.read(MAX_CHUNK_SIZE)
+        if not data:
+            return
+        yield data
+        start += len(data)
+
+
+def pack_chunk(data):
+    """
+    The stored form of a chunk: "z" and its zlib-compressed data, or "r" and
+    the data itself if that doesn't compress.
+    """
+    compressed = zlib.compress(data, 6)
+    if len(compressed) < len(data):
+        return 'z' + compressed
+    return 'r' + data
+
+
+def unpack_chunk(body):
+    if body[:1] == 'z':
+        return zlib.decompress(body[1:])
+    return body[1:]
+
+
+# ========== Chunk index ==========
+
+class ChunkIndex(object):
+    """
+    Local SQLite index, kept in `INDEX_DIR`, of the chunks stored in a
+    bucket and of the files backed up from this machine: their size, mtime,
+    ctime and chunks, so that unchanged files can be skipped.
+    """
+    def __init__(self, bucket_name):
+        path = os.path.join(os.path.expanduser(INDEX_DIR),
+            bucket_name + '.sqlite')
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                hash TEXT PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                ctime REAL,
+                chunks TEXT
+            );
+            CREATE TABLE IF NOT EXISTS state (
+                name TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+
+    def is_built(self):
+        return self.db.execute(
+            "SELECT COUNT(*) FROM state WHERE name = 'built'").fetchone()[0] > 0
+
+    def rebuild(self, bucket):
+        """
+        Replaces the known chunks with a listing of those in `bucket`.
+        Returns how many there are.
+        """
+        prefix = DEDUP_PREFIX + 'chunks/'
+        with self.db:
+            self.db.execute("DELETE FROM chunks")
+            self.db.executemany("INSERT OR IGNORE INTO chunks VALUES (?)",
+                ((key.name.rsplit('/', 1)[-1],) for key in s3client.list_keys(
+                    bucket, prefix, s3up.LIST_PARALLELIZATION)))
+            self.db.execute("INSERT OR REPLACE INTO state VALUES ('built', ?)",
+                (str(time()),))
+        return self.db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def known_chunks(self):
+        return set(row[0] for row in self.db.execute("SELECT hash FROM chunks"))
+
+    def add_chunks(self, hashes):
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO chunks VALUES (?)",
+                ((h,) for h in hashes))
+
+    def cached_chunks(self, path, st):
+        """
+        The chunks of the file at `path` as of its last backup, if it still
+        has the same size, mtime and ctime (`st`), or None.
+        """
+        row = self.db.execute("SELECT size, mtime, ctime, chunks FROM files "
+            "WHERE path = ?", (path,)).fetchone()
+        if row and tuple(row[:3]) == (st.st_size, st.st_mtime, st.st_ctime):
+            return json.loads(row[3])
+        return None
+
+    def set_files(self, files):
+        """
+        Records `(path, stat, chunks)` for backed up files.
+        """
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                ((path, st.st_size, st.st_mtime, st.st_ctime, json.dumps(chunks))
+                    for path, st, chunks in files))
+
+
+def get_index(bucket):
+    """
+    Opens the `ChunkIndex` of `bucket`, building it first if needed.
+    """
+    index = ChunkIndex(bucket.name)
+    if not index.is_built():
+        print("Indexing the chunks already in '%s'..." % bucket.name,
+            file=sys.stderr)
+        index.rebuild(bucket)
+    return index
+
+
+# ========== Backup ==========
+
+def chunk_key(chunk_hash):
+    return "%schunks/%s/%s" % (DEDUP_PREFIX, chunk_hash[:2], chunk_hash)
+
+
+def put_object(bucket, remote_path, body, progress=None):
+    """
+    Stores `body` at `remote_path`, private and encrypted at rest, retrying
+    as `s3up.get_retry_policy` sees fit.
+    """
+    key = bucket.new_key(remote_path)
+    md5 = hashlib.md5(body)
+    start = time()
+    if progress:
+        progress.part_started()
+    ok = False
+    try:
+        s3up.get_retry_policy().call(key.set_contents_from_string, body,
+            policy='private', encrypt_key=True,
+            md5=(md5.hexdigest(), base64.b64encode(md5.digest())))
+        ok = True
+    finally:
+        if progress:
+            progress.part_finished(time() - start, 0, ok)
+    if progress:
+        progress.add_bytes(len(body))
+
+
+def backup_dir(local_dir, name, bucket):
+    """
+    Backs up `local_dir` as a new snapshot of `name` in `bucket`. Returns
+    the path of its manifest.
+    """
+    index = get_index(bucket)
+    known = index.known_chunks()
+    uploaded = []
+    uploaded_lock = Lock()
+    files = []
+    entries = []
+    changed = []
+    stats = {'files': 0, 'changed': 0, 'bytes': 0, 'new_chunks': 0,
+        'new_bytes': 0}
+
+    # Started before any thread is, so that the processes don't inherit
+    # locks held by one.
+    scanners = Pool(SCAN_PROCESSES) if SCAN_PROCESSES > 1 else None
+    pool = s3up.UploadPool(DEDUP_PARALLELIZATION)
+    progress = s3up.UploadProgress(name, 0).start()
+
+    def upload_chunk(chunk_hash, data):
+        body = pack_chunk(data)
+        with uploaded_lock:
+            stats['new_bytes'] += len(body)
+        progress.add_total(len(body))
+        put_object(bucket, chunk_key(chunk_hash), body, progress)
+        with uploaded_lock:
+            uploaded.append(chunk_hash)
+
+    def store_chunks(chunks_data):
+        chunks = []
+        for data in chunks_data:
+            chunk_hash = hashlib.sha256(data).hexdigest()
+            chunks.append([chunk_hash, len(data)])
+            if chunk_hash not in known:
+                known.add(chunk_hash)
+                stats['new_chunks'] += 1
+                pool.submit(upload_chunk, chunk_hash, data)
+        return chunks
+
+    local_dir = os.path.abspath(local_dir)
+    status = 'failed'
+    try:
+        for root, dirs, filenames in os.walk(local_dir):
+            dirs.sort()
+            for filename in sorted(filenames) + [d for d in dirs
+                    if os.path.islink(os.path.join(root, d))]:
+                path = os.path.join(root, filename)
+                rel_path = os.path.relpath(path, local_dir)
+                st = os.lstat(path)
+                entry = {'path': rel_path, 'mode': stat.S_IMODE(st.st_mode),
+                    'mtime': st.st_mtime}
+                if stat.S_ISLNK(st.st_mode):
+                    entry['type'] = 'link'
+                    entry['target'] = os.readlink(path)
+                elif stat.S_ISREG(st.st_mode):
+                    entry['type'] = 'file'
+                    chunks = index.cached_chunks(path, st)
+                    if chunks is None or \
+                            not all(h in known for h, size in chunks):
+                        # Chunked below, once every file is found.
+                        changed.append((path, st, entry))
+                    else:
+                        files.append((path, st, chunks))
+                        entry['chunks'] = chunks
+                        entry['size'] = sum(size for h, size in chunks)
+                        stats['bytes'] += entry['size']
+                    stats['files'] += 1
+                else:
+                    # Sockets, FIFOs, devices...
+                    continue
+                entries.append(entry)
+            if root != local_dir:
+                st = os.stat(root)
+                entries.append({'path': os.path.relpath(root, local_dir),
+                    'type': 'dir', 'mode': stat.S_IMODE(st.st_mode),
+                    'mtime': st.st_mtime})
+            # Symlinks to directories were recorded above, not followed.
+            dirs[:] = [d for d in dirs
+                if not os.path.islink(os.path.join(root, d))]
+
+        # Every block of every changed file is handed to the scanners at
+        # once; their results come back in order while earlier files are
+        # being chunked and uploaded.
+        blocks = [(changed_path, offset, length)
+            for changed_path, changed_st, changed_entry in changed
+            for offset, length in scan_blocks(changed_st.st_size)]
+        if scanners:
+            results = scanners.imap(find_boundaries, blocks)
+        else:
+            results = imap(find_boundaries, blocks)
+        for path, st, entry in changed:
+            if pool.failed.is_set():
+                break
+            boundaries = []
+            for block in scan_blocks(st.st_size):
+                boundaries.extend(next(results))
+            with open(path, 'rb') as fp:
+                chunks = store_chunks(chunk_file(fp, boundaries))
+            files.append((path, st, chunks))
+            entry['chunks'] = chunks
+            entry['size'] = sum(size for h, size in chunks)
+            stats['bytes'] += entry['size']
+            stats['changed'] += 1
+
+        pool.join()
+
+        snapshot = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+        manifest = {
+            'name': name,
+            'snapshot': snapshot,
+            'source': local_dir,
+            'chunking': [MIN_CHUNK_SIZE, AVG_CHUNK_SIZE, MAX_CHUNK_SIZE],
+            'entries': entries,
+        }
+        body = StringIO()
+        with gzip.GzipFile(fileobj=body, mode='wb') as fp:
+            json.dump(manifest, fp)
+        manifest_path = "%smanifests/%s/%s.json.gz" % (DEDUP_PREFIX, name,
+            snapshot)
+        put_object(bucket, manifest_path, body.getvalue())
+        index.set_files(files)
+        status = 'done'
+    finally:
+        if scanners:
+            scanners.terminate()
+            scanners.join()
+        pool.join(reraise=False)
+        with uploaded_lock:
+            # Whatever made it, even if the backup failed.
+            index.add_chunks(uploaded)
+        progress.stop(status)
+
+    print("%d files (%s), %d changed; uploaded %d new chunks (%s)."
+        % (stats['files'], s3up.format_size(stats['bytes']), stats['changed'],
+        stats['new_chunks'], s3up.format_size(stats['new_bytes'])),
+        file=sys.stderr)
+    return manifest_path
+
+
+# ========== Restore ==========
+
+def snapshots(bucket, name=None):
+    """
+    The manifest paths of every snapshot of `name` (or, without a name, the
+    names backed up), oldest first.
+    """
+    prefix = DEDUP_PREFIX + 'manifests/'
+    if name is None:
+        return sorted(item.name[len(prefix):].rstrip('/')
+            for item in bucket.list(prefix, '/'))
+    return sorted(key.name for key in bucket.list(prefix + name + '/'))
+
+
+def get_object(bucket, remote_path):
+    key = bucket.new_key(remote_path)
+    return s3up.get_retry_policy().call(key.get_contents_as_string)
+
+
+def clear_path(path):
+    """
+    Removes whatever file or symlink is at `path`, so it can be restored
+    (a symlink would otherwise be written through, or fail to be created).
+    Returns False if a directory is in the way.
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        return False
+    if os.path.lexists(path):
+        os.remove(path)
+    return True
+
+
+def restore_file(bucket, entry, path):
+    with open(path, 'wb') as fp:
+        for chunk_hash, size in entry['chunks']:
+            data = unpack_chunk(get_object(bucket, chunk_key(chunk_hash)))
+            if hashlib.sha256(data).hexdigest() != chunk_hash:
+                raise Exception("Chunk %s of %s is corrupt."
+                    % (chunk_hash, entry['path']))
+            fp.write(data)
+    os.chmod(path, entry['mode'])
+    os.utime(path, (entry['mtime'], entry['mtime']))
+
+
+def restore_dir(name, local_dir, bucket, snapshot=None):
+    """
+    Restores the latest snapshot of `name` (or the given one) from `bucket`
+    into `local_dir`, fetching `DEDUP_PARALLELIZATION` files at once.
+    """
+    manifests = snapshots(bucket, name)
+    if snapshot:
+        manifests = [m for m in manifests if snapshot in m.rsplit('/', 1)[-1]]
+    if not manifests:
+        raise Exception("No snapshot of %s found." % name)
+    body = get_object(bucket, manifests[-1])
+    manifest = json.load(gzip.GzipFile(fileobj=StringIO(body)))
+    print("Restoring %s from %s..." % (name, manifest['snapshot']),
+        file=sys.stderr)
+
+    if not os.path.isdir(local_dir):
+        os.makedirs(local_dir)
+    pool = s3up.UploadPool(DEDUP_PARALLELIZATION)
+    dirs = []
+    try:
+        for entry in manifest['entries']:
+            path = os.path.join(local_dir, entry['path'])
+            if entry['type'] == 'dir':
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                dirs.append((path, entry))
+                continue
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            if not clear_path(path):
+                print("Skipping %s: a directory is in the way." % path,
+                    file=sys.stderr)
+                continue
+            if entry['type'] == 'link':
+                os.symlink(entry['target'], path)
+            else:
+                pool.submit(restore_file, bucket, entry, path)
+            if pool.failed.is_set():
+                break
+    finally:
+        pool.join()
+    # Only now, since restoring their contents changed their mtimes.
+    for path, entry in dirs:
+        os.chmod(path, entry['mode'])
+        os.utime(path, (entry['mtime'], entry['mtime']))
+
+
+def main(args):
+    bucket_name = s3up.AWS_DEFAULT_BUCKET
+    for arg in list(args):
+        if arg.startswith("--bucket="):
+            bucket_name = arg.split("=", 1)[1]
+            args.remove(arg)
+    if not args or args[0] in ("--help", "-h", "-?"):
+        print(__doc__.split("-----")[1].strip())
+        return
+    command, args = args[0], args[1:]
+    bucket = s3up.get_bucket(bucket_name)
+
+    if command == "backup" and len(args) in (1, 2):
+        name = args[1] if len(args) == 2 else \
+            os.path.basename(os.path.abspath(args[0]))
+        print(backup_dir(args[0], name, bucket))
+    elif command == "list" and len(args) <= 1:
+        for item in snapshots(bucket, *args):
+            print(item)
+    elif command == "restore" and len(args) in (2, 3):
+        restore_dir(args[0], args[1], bucket, *args[2:])
+    elif command == "reindex" and not args:
+        print("%d chunks." % ChunkIndex(bucket.name).rebuild(bucket))
+    else:
+        print(__doc__.split("-----")[1].strip())
+        sys.exit(1)
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+    except Exception, e:
+        sys.stderr.write('\n')
+        traceback.print_exc(file=sys.stderr)
+        sys.stderr.write('\n')
+        sys.exit(1)
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+s3down.py
+
+Companion to `s3up`: downloads an object from S3 with many ranged GETs at
+once, which is a lot faster than a single stream for large files (like the
+backups made by `backup_dir.sh`).
+
+Copyright 2013, Mike Tigas
+https://mike.tig.as/
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+-----
+
+Requires boto: http://boto.cloudhackers.com/
+Relies on `s3up.py` in this directory.
+
+Usage:
+  s3down remote_path
+    Downloads the given key from AWS_DEFAULT_BUCKET into the current
+    directory, under the same filename.
+
+  s3down remote_path local_file
+  s3down bucket remote_path local_file
+    As above, into `local_file`. A `local_file` of - writes the object to
+    stdout, in order, e.g. to restore a backup without storing it first:
+        s3down my-bucket 20130101-00-UTC/dir.tar.xz.gpg - | tar -xf - -Igpgxz.sh
+
+  s3down --progress=MODE ...
+    Any of the above, reporting progress like `s3up --progress=MODE`.
+
+An object uploaded in parts is fetched in those parts (a GET with
+`?partNumber=N` per part, which also says where in the object the part
+goes), anything else in the chunks `s3up` would have split it into (see
+CHUNK_SIZE). DOWNLOAD_PARALLELIZATION chunks are fetched at once, each
+retried as configured by CHUNK_RETRIES. A file is written under a temporary name
+(preallocated to the full size) and only renamed into place once complete.
+The result is checked against the object's ETag whenever that can be
+computed from the chunks: always for objects uploaded in parts, and for
+others that fit into a single chunk.
+
+The options are shared with `s3up.py` (and `dotfiles_config.py`).
+"""
+from __future__ import print_function
+import hashlib
+import os
+import re
+import sys
+import traceback
+import s3up
+from boto.exception import S3ResponseError
+from errno import EPIPE
+from Queue import Empty, Queue
+from threading import Thread
+from time import time
+
+
+def chunk_ranges(size):
+    """
+    Returns the `(start, end)` byte ranges (inclusive, as in a Range
+    header) of the chunks `s3up` would upload an object of `size` bytes in.
+    """
+    if size < s3up.MULTIPART_THRESHOLD:
+        return [(0, size - 1)]
+    chunk_size, num_chunks = s3up.chunk_layout(size)
+    ranges = [(chunk_size * i, chunk_size * (i + 1) - 1)
+        for i in range(num_chunks)]
+    ranges[-1] = (ranges[-1][0], size - 1)
+    return ranges
+
+
+def fetch_part(key, number):
+    """
+    GETs part `number` of `key`, which was uploaded in parts, failing (with
+    a 412, which isn't retried) if the object was replaced since `key` was
+    looked up. Returns the offset of the part in the object, and its data.
+    """
+    response = key.bucket.connection.make_request('GET', key.bucket.name,
+        key.name, headers={'If-Match': key.etag},
+        query_args='partNumber=%d' % number)
+    data = response.read()
+    if response.status != 206:
+        raise S3ResponseError(response.status, response.reason, data)
+    match = re.match(r'bytes (\d+)-(\d+)/\d+',
+        response.getheader('content-range') or '')
+    if not match:
+        raise IOError("Got no Content-Range for part %d of %s."
+            % (number, key.name))
+    start, end = int(match.group(1)), int(match.group(2))
+    if len(data) != end - start + 1:
+        raise IOError("Got %d bytes of part %d of %s instead of %d."
+            % (len(data), number, key.name, end - start + 1))
+    return start, data
+
+
+def fetch_range(key, start, end):
+    """
+    GETs bytes `start` to `end` of `key`, failing (with a 412, which isn't
+    retried) if the object was replaced since `key` was looked up. Returns
+    `start`, and the data.
+    """
+    part = key.bucket.new_key(key.name)
+    data = part.get_contents_as_string(headers={
+        'Range': 'bytes=%d-%d' % (start, end),
+        'If-Match': key.etag,
+    })
+    if len(data) != end - start + 1:
+        raise IOError("Got %d bytes of %s instead of %d (bytes %d-%d)."
+            % (len(data), key.name, end - start + 1, start, end))
+    return start, data
+
+
+def download_worker(todo, results, progress):
+    policy = s3up.get_retry_policy()
+    while True:
+        item = todo.get()
+        if item is None:
+            return
+        index, (fetch, args) = item
+        progress.part_started()
+        started = time()
+        ok = False
+        try:
+            start, data = policy.call(fetch, *args)
+            ok = True
+        except Exception:
+            results.put((index, None, None, sys.exc_info()))
+        finally:
+            progress.part_finished(time() - started, 0, ok)
+        if ok:
+            progress.add_bytes(len(data))
+            results.put((index, start, data, None))
+
+
+def check_etag(key, chunks, digests):
+    """
+    Compares the MD5s of the `chunks` downloaded chunks against the ETag of
+    `key`, if its ETag can be computed from them: for a multipart upload
+    (whose parts they are), or if there was only one. Returns whether it
+    could.
+    """
+    etag = key.etag.strip('"')
+    if '-' in etag:
+        expected = digests.etag()
+    elif chunks <= 1:
+        expected = digests.md5.get(1, hashlib.md5().digest()).encode('hex')
+    else:
+        return False
+    if etag != expected:
+        raise Exception("%s has ETag %s, but the downloaded data adds up to "
+            "%s; the download is corrupt." % (key.name, etag, expected))
+    return True
+
+
+def download_file(bucket, remote_path, local_file, threads=None):
+    """
+    Downloads `remote_path` from `bucket` (a name or `Bucket`) into
+    `local_file`, or to stdout if `local_file` is "-", fetching `threads`
+    (default: `DOWNLOAD_PARALLELIZATION`) chunks at a time.
+    """
+    if not hasattr(bucket, 'get_key'):
+        bucket = s3up.get_bucket(bucket)
+    threads = threads or s3up.DOWNLOAD_PARALLELIZATION
+    key = s3up.get_retry_policy().call(bucket.get_key, remote_path)
+    if key is None:
+        raise Exception("%s not found in %s." % (remote_path, bucket.name))
+
+    to_stdout = local_file == '-'
+    if to_stdout:
+        fp = sys.stdout
+    else:
+        temp_file = local_file + '.s3down'
+        fp = open(temp_file, 'wb')
+        fp.truncate(key.size)
+
+    # A multipart ETag can only be checked with the real part boundaries,
+    # which needn't be the ones `chunk_ranges` picks (e.g. for an adaptive
+    # upload, or one made with a different CHUNK_SIZE), so fetch it by part.
+    etag = key.etag.strip('"')
+    if '-' in etag:
+        chunks = [(fetch_part, (key, number))
+            for number in range(1, int(etag.split('-')[1]) + 1)]
+    elif key.size:
+        chunks = [(fetch_range, (key, start, end))
+            for start, end in chunk_ranges(key.size)]
+    else:
+        chunks = []
+    # Chunks fetched but not yet written are held in memory; stdout has to
+    # wait for the oldest one, so allow a few more than there are threads.
+    window = threads * 2
+    todo = Queue()
+    results = Queue()
+    progress = s3up.UploadProgress(remote_path, key.size).start()
+    workers = [Thread(target=download_worker,
+        args=(todo, results, progress)) for i in range(threads)]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+
+    digests = s3up.PartDigests()
+    pending = {}
+    issued = written = 0
+    status = 'failed'
+    try:
+        while written < len(chunks):
+            while issued < len(chunks) and issued - written < window:
+                todo.put((issued, chunks[issued]))
+                issued += 1
+            index, start, data, error = results.get()
+            if error is not None:
+                raise error[0], error[1], error[2]
+            digests.add(index + 1, hashlib.md5(data).digest())
+            if to_stdout:
+                pending[index] = data
+                while written in pending:
+                    fp.write(pending.pop(written))
+                    written += 1
+            else:
+                fp.seek(start)
+                fp.write(data)
+                written += 1
+        fp.flush()
+        status = 'done'
+    finally:
+        if status != 'done':
+            # Drop the chunks no thread has started on yet.
+            try:
+                while True:
+                    todo.get_nowait()
+            except Empty:
+                pass
+        for thread in workers:
+            todo.put(None)
+        for thread in workers:
+            thread.join()
+        progress.stop(status)
+        if not to_stdout:
+            fp.close()
+            if status != 'done':
+                os.remove(temp_file)
+
+    try:
+        if not check_etag(key, len(chunks), digests):
+            sys.stderr.write("Note: can't check %s against its ETag (%s).\n"
+                % (remote_path, key.etag))
+    except Exception:
+        if not to_stdout:
+            os.remove(temp_file)
+        raise
+    if not to_stdout:
+        os.rename(temp_file, local_file)
+
+
+def print_help():
+    print("Downloads a file from S3 with parallel ranged GETs.")
+    print()
+    print("Usage:")
+    print("s3down remote_path")
+    print("    Downloads the given key from AWS_DEFAULT_BUCKET (%s) into the current" % s3up.AWS_DEFAULT_BUCKET)
+    print("    directory.")
+    print()
+    print("s3down remote_path local_file")
+    print("s3down bucket remote_path local_file")
+    print("    A local_file of - writes to stdout, e.g.:")
+    print("      s3down my-bucket backups/dir.tar.xz.gpg - | tar -xf - -Igpgxz.sh")
+    print()
+    print("Options (before the remote path):")
+    print("  --progress=MODE")
+    print("              Report progress as a bar, json lines, both or none.")
+
+
+def main(args):
+    for arg in list(args):
+        if arg.startswith("--progress="):
+            args.remove(arg)
+            s3up.PROGRESS = arg.split("=", 1)[1]
+
+    if not args or args[0] in ("--help", "-h", "-?"):
+        print_help()
+    elif len(args) == 3:
+        download_file(args[0], args[1], args[2])
+    elif len(args) == 2:
+        download_file(s3up.AWS_DEFAULT_BUCKET, args[0], args[1])
+    elif len(args) == 1:
+        download_file(s3up.AWS_DEFAULT_BUCKET, args[0],
+            os.path.basename(args[0]))
+    else:
+        print_help()
+
+if __name__ == '__main__':
+    try:
+        main(sys.argv[1:])
+    except IOError, e:
+        if e.errno != EPIPE:
+            sys.stderr.write('\n')
+            traceback.print_exc(file=sys.stderr)
+            sys.stderr.write('\n')
+        sys.exit(1)
+    except Exception, e:
+        sys.stderr.write('\n')
+        traceback.print_exc(file=sys.stderr)
+        sys.stderr.write('\n')
+        sys.exit(1)
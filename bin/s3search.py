@@ -27,10 +27,38 @@ Requires boto: http://boto.cloudhackers.com/
 Relies on `s3up.py` in this directory.
 
 Usage:
-  s3search [bucket]
+  s3search [options] [bucket]
+    Prompts for the filename to search for, and prints the URLs of the
+    matching keys.
 
-You will then be prompted for the filename to search for. If `bucket` is
-not given, `AWS_DEFAULT_BUCKET` is used.
+  s3search [options] -e pattern [-e pattern ...] [bucket]
+    Prints the keys matching any of the patterns as they are found, without
+    prompting, for use in scripts and cron jobs.
+
+If `bucket` is not given, `AWS_DEFAULT_BUCKET` is used. By default, every
+key containing the search string matches; with `--glob` it is a shell-style
+pattern (e.g. `files/2013*/*.jpg`) and with `--regex` a regular expression
+that must match somewhere in the key.
+
+Options:
+  --glob, --regex   Pattern syntax (see above).
+  --json            Print a JSON object per match (key, url, size, etag,
+                    last_modified) instead of just its URL.
+  --limit=N         Stop after N matches.
+  --live            Search a fresh listing of the bucket instead of the
+                    index. Matches are printed while the listing runs,
+                    and listing stops as soon as `--limit` is reached.
+  --refresh, --refresh=prefix
+                    Update the index first (see below).
+
+Searches run against a local index of the bucket's keys (see `INDEX_DIR`),
+without listing the bucket: it is only listed to build the index, the first
+time a bucket is searched, and when asked to with `--refresh`. That lists
+the bucket again but only rewrites what changed: the keys at the top level
+page by page, and each top-level prefix (e.g. `files/`) only if its key
+count or newest LastModified differ from the index. `--refresh=prefix`
+does the same for just `prefix` (all of the bucket if it is empty). A
+search notes when the index is older than `INDEX_MAX_AGE`.
 
 Before using, please configure at least the following options in `s3up.py`:
     AWS_ACCESS_KEY_ID
@@ -40,15 +68,287 @@ Before using, please configure at least the following options in `s3up.py`:
     BUCKET_CNAME
 (Note, you can also set these in `dotfiles_config.py` -- see example file.)
 """
+import fnmatch
+import json
+import os
+import re
+import sqlite3
 import sys
 import traceback
-from boto.s3.connection import S3Connection
+from errno import EPIPE
 from socket import setdefaulttimeout
+from time import time
 setdefaulttimeout(100.0)
 
+import s3client
 import s3up
+from boto.s3.prefix import Prefix
+
+# Where the local index of each bucket's keys is kept.
+INDEX_DIR = '~/.s3up/index'
+
+# Searching an index that was last updated more than this many seconds ago
+# suggests running `--refresh`.
+INDEX_MAX_AGE = 86400
+
+_regexps = {}
+
+def _regexp(pattern, value):
+    if pattern not in _regexps:
+        _regexps[pattern] = re.compile(pattern)
+    return _regexps[pattern].search(value) is not None
+
+def prefix_range(prefix):
+    """
+    Returns `(low, high)` such that exactly the names starting with
+    `prefix` (which mustn't be empty) sort in `low <= name < high`.
+    """
+    if not prefix:
+        raise ValueError("Every name starts with an empty prefix.")
+    return prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+class KeyIndex(object):
+    """
+    Local SQLite index of the keys in a bucket (name, size, last modified
+    and ETag), kept in `INDEX_DIR`, so that a search doesn't have to list
+    the whole bucket.
+
+    The keys at the top level of the bucket (without a "/") are indexed a
+    page at a time, and the rest one top-level prefix (everything up to the
+    first "/") at a time, so that `refresh` only rewrites what changed.
+    """
+    def __init__(self, bucket_name):
+        path = os.path.join(os.path.expanduser(INDEX_DIR),
+            bucket_name + '.sqlite')
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path)
+        self.db.create_function('regexp', 2, _regexp)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS keys (
+                name TEXT PRIMARY KEY,
+                size INTEGER,
+                last_modified TEXT,
+                etag TEXT
+            );
+            CREATE TABLE IF NOT EXISTS prefixes (
+                prefix TEXT PRIMARY KEY,
+                refreshed REAL
+            );
+            CREATE TABLE IF NOT EXISTS state (
+                name TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+
+    def last_refreshed(self):
+        """
+        When the whole bucket was last listed, as a Unix time, or None if it
+        never was (i.e. the index is empty).
+        """
+        row = self.db.execute(
+            "SELECT value FROM state WHERE name = 'refreshed'").fetchone()
+        return float(row[0]) if row else None
+
+    def _store(self, keys):
+        self.db.executemany("INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?)",
+            ((k.name, k.size, k.last_modified, k.etag) for k in keys))
+
+    def refresh_prefix(self, bucket, prefix):
+        """
+        Lists everything under `prefix` (all of the bucket if it is empty)
+        and, if its key count or newest LastModified differ from what is
+        indexed, replaces the index's keys under `prefix` with the listing.
+        Returns whether it did.
+        """
+        if not prefix:
+            return self.refresh(bucket)[1] > 0
+        keys = list(s3client.list_keys(bucket, prefix,
+            s3up.LIST_PARALLELIZATION))
+        low, high = prefix_range(prefix)
+        indexed = self.db.execute("SELECT COUNT(*), MAX(last_modified) "
+            "FROM keys WHERE name >= ? AND name < ?", (low, high)).fetchone()
+        listed = (len(keys), max([k.last_modified for k in keys] or [None]))
+        changed = tuple(indexed) != listed
+        with self.db:
+            if changed:
+                self.db.execute("DELETE FROM keys WHERE name >= ? AND name < ?",
+                    (low, high))
+                self._store(keys)
+            if prefix.count('/') == 1 and prefix.endswith('/'):
+                self.db.execute("INSERT OR REPLACE INTO prefixes VALUES (?, ?)",
+                    (prefix, time()))
+        return changed
+
+    def _refresh_top_keys(self, keys, after, through):
+        """
+        Makes the index's top-level keys named after `after` (if not None)
+        and up to `through` (if not None) match `keys`, one page of the
+        top-level listing.
+        """
+        sql = "SELECT name FROM keys WHERE name NOT LIKE '%/%'"
+        params = []
+        if after is not None:
+            sql += " AND name > ?"
+            params.append(after)
+        if through is not None:
+            sql += " AND name <= ?"
+            params.append(through)
+        listed = set(k.name for k in keys)
+        gone = [(name,) for name, in self.db.execute(sql, params)
+            if name not in listed]
+        with self.db:
+            self.db.executemany("DELETE FROM keys WHERE name = ?", gone)
+            self._store(keys)
+
+    def refresh(self, bucket):
+        """
+        Brings the index up to date with a listing of the bucket: its
+        top-level keys are indexed as each page of the top level is listed,
+        prefixes that are gone are dropped, and every top-level prefix is
+        listed with `refresh_prefix`. Returns the number of top-level
+        prefixes, and how many of them had changed.
+        """
+        prefixes = []
+        after = None
+        for page in s3client.key_pages(bucket, '', '/'):
+            if not len(page):
+                break
+            prefixes.extend(item.name for item in page
+                if isinstance(item, Prefix))
+            through = page[-1].name
+            self._refresh_top_keys([item for item in page
+                if not isinstance(item, Prefix)], after, through)
+            after = through
+        self._refresh_top_keys([], after, None)
+
+        indexed = set(row[0] for row in
+            self.db.execute("SELECT prefix FROM prefixes"))
+        with self.db:
+            for prefix in indexed - set(prefixes):
+                self.db.execute("DELETE FROM keys WHERE name >= ? AND name < ?",
+                    prefix_range(prefix))
+                self.db.execute("DELETE FROM prefixes WHERE prefix = ?",
+                    (prefix,))
+
+        changed = sum(1 for prefix in prefixes
+            if self.refresh_prefix(bucket, prefix))
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO state VALUES "
+                "('refreshed', ?)", (str(time()),))
+        return len(prefixes), changed
+
+    def search(self, patterns, mode='substring', limit=None):
+        """
+        Yields `(name, size, last_modified, etag)` for each indexed key
+        matching any of `patterns`: keys containing it (`mode`
+        "substring"), matching it as a shell-style pattern ("glob"), or in
+        which the regular expression matches ("regex"). Stops after `limit`
+        keys, if given.
+        """
+        if mode == 'glob':
+            where = "name GLOB ?"
+        elif mode == 'regex':
+            where = "name REGEXP ?"
+        else:
+            where = "instr(name, ?) > 0"
+        sql = "SELECT name, size, last_modified, etag FROM keys WHERE %s " \
+            "ORDER BY name" % " OR ".join([where] * len(patterns))
+        if limit:
+            sql += " LIMIT %d" % limit
+        return self.db.execute(sql, [unicode(p) for p in patterns])
+
+def glob_prefix(pattern):
+    """
+    The literal start of a shell-style `pattern`, up to its first wildcard.
+    """
+    return re.split(r'[*?\[]', pattern, 1)[0]
+
+def key_matcher(patterns, mode='substring'):
+    """
+    Returns a function telling whether a key name matches any of `patterns`,
+    the same way `KeyIndex.search` does.
+    """
+    if mode == 'glob':
+        # Like SQLite's GLOB: case-sensitive, and `*` also matches "/".
+        regexps = [re.compile(fnmatch.translate(p)) for p in patterns]
+        return lambda name: any(r.match(name) for r in regexps)
+    if mode == 'regex':
+        regexps = [re.compile(p) for p in patterns]
+        return lambda name: any(r.search(name) for r in regexps)
+    patterns = [unicode(p) for p in patterns]
+    return lambda name: any(p in name for p in patterns)
+
+def live_search(bucket, patterns, mode='substring', limit=None):
+    """
+    Like `KeyIndex.search`, but against a fresh (parallel) listing of
+    `bucket`. Matches are yielded as the listing finds them, in no
+    particular order, and the listing stops once `limit` keys matched.
+    Glob patterns only list the part of the bucket they can match.
+    """
+    prefix = ''
+    if mode == 'glob':
+        prefix = os.path.commonprefix([glob_prefix(p) for p in patterns])
+    matches = key_matcher(patterns, mode)
+    found = 0
+    listing = s3client.list_keys(bucket, prefix, s3up.LIST_PARALLELIZATION)
+    try:
+        for key in listing:
+            if matches(key.name):
+                yield key.name, key.size, key.last_modified, key.etag
+                found += 1
+                if limit and found >= limit:
+                    return
+    finally:
+        listing.close()
+
+def print_match(host_path, match, as_json=False):
+    name, size, last_modified, etag = match
+    url = "%s/%s" % (host_path, name)
+    if as_json:
+        print json.dumps({
+            'key': name,
+            'url': url,
+            'size': size,
+            'etag': etag and etag.strip('"'),
+            'last_modified': last_modified,
+        })
+    else:
+        print url.encode('utf-8')
+    sys.stdout.flush()
 
 def main(args):
+    mode = 'substring'
+    refresh = False
+    refresh_prefixes = []
+    patterns = []
+    as_json = False
+    limit = None
+    live = False
+    rest = []
+    args = iter(args)
+    for arg in args:
+        if arg in ("--glob", "--regex"):
+            mode = arg[2:]
+        elif arg == "--refresh":
+            refresh = True
+        elif arg.startswith("--refresh="):
+            refresh_prefixes.append(unicode(arg.split("=", 1)[1]))
+        elif arg in ("-e", "--pattern"):
+            patterns.append(next(args))
+        elif arg.startswith("--pattern="):
+            patterns.append(arg.split("=", 1)[1])
+        elif arg == "--json":
+            as_json = True
+        elif arg.startswith("--limit="):
+            limit = int(arg.split("=", 1)[1])
+        elif arg == "--live":
+            live = True
+        else:
+            rest.append(arg)
+    args = rest
+    interactive = not patterns
+
     if len(args) == 1:
         bucket_name = args[0]
     #elif len(args) == 0:
@@ -60,23 +360,47 @@ def main(args):
     else:
         host_path = "https://s3.amazonaws.com/%s" % bucket_name
 
-    searchstr = raw_input("Look for files containing:\n")
-    print
+    if interactive:
+        patterns = [raw_input("Look for files containing:\n")]
+        print
+
+    # Only matches go to stdout, unless we're talking to a person.
+    log = sys.stdout if interactive else sys.stderr
+
+    bucket = s3up.get_bucket(bucket_name)
+    if live:
+        matches = live_search(bucket, patterns, mode, limit)
+    else:
+        index = KeyIndex(bucket_name)
+        refreshed = index.last_refreshed()
+        if refresh or refreshed is None:
+            log.write("Updating the index of '%s'...\n" % bucket_name)
+            log.write("%d prefixes, %d of them changed.\n\n"
+                % index.refresh(bucket))
+        elif time() - refreshed > INDEX_MAX_AGE:
+            log.write("Note: the index of '%s' is %d hours old; run with "
+                "--refresh to update it.\n\n" % (bucket_name,
+                (time() - refreshed) / 3600))
+        for prefix in refresh_prefixes:
+            index.refresh_prefix(bucket, prefix)
+        matches = index.search(patterns, mode, limit)
+
+    if interactive:
+        print "Searching '%s' for '%s'..." % (bucket_name, patterns[0])
+        print
 
-    print "Searching '%s' for '%s'..." % (bucket_name, searchstr)
-    print
+    try:
+        for match in matches:
+            print_match(host_path, match, as_json)
+    except IOError, e:
+        if e.errno != EPIPE:
+            raise
+        # Whatever we're piped into (e.g. `head`) has seen enough.
+        return
 
-    s3 = S3Connection(
-        aws_access_key_id=s3up.AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=s3up.AWS_SECRET_ACCESS_KEY,
-        host=s3up.S3_ENDPOINT
-    )
-    bucket = s3.get_bucket(bucket_name)
-    for k in bucket.list():
-        if unicode(searchstr) in k.name:
-            print "%s/%s" % (host_path, k.name)
-    print
-    raw_input("Press enter to continue...")
+    if interactive:
+        print
+        raw_input("Press enter to continue...")
 
 if __name__ == '__main__':
     try:
@@ -86,5 +410,6 @@ if __name__ == '__main__':
         traceback.print_exc(file=sys.stderr)
         sys.stderr.write('\n')
         print sys.argv[1:]
-        raw_input("Press enter to continue...")
+        if sys.stdin.isatty():
+            raw_input("Press enter to continue...")
         sys.exit(1)
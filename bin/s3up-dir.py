@@ -28,6 +28,12 @@ Relies on `s3up.py` in this directory.
 
 Usage:
   s3up-dir local_directory remote_directory
+  s3up-dir --sync local_directory remote_directory
+    Only uploads files that are missing or different in S3 (see
+    USE_DELTA_UPLOAD).
+
+Files are uploaded concurrently, sharing `DIR_UPLOAD_PARALLELIZATION` upload
+threads between them; the resulting URLs are printed once all are done.
 
 Before using, please configure at least the following options in `s3up.py`:
     AWS_ACCESS_KEY_ID
@@ -37,25 +43,87 @@ Before using, please configure at least the following options in `s3up.py`:
     BUCKET_CNAME
 (Note, you can also set these in `dotfiles_config.py` -- see example file.)
 """
+import hashlib
+import json
 import sys
 import traceback
 import os
+import s3client
 import s3up
-from boto.s3.connection import S3Connection
 from socket import setdefaulttimeout
 setdefaulttimeout(100.0)
 
-# TODO
-# note: not compatible with multipart (parallelized) upload due to
-# different etag calculation.
-# see https://forums.aws.amazon.com/thread.jspa?messageID=203436
+# Only upload files that are missing in S3 or whose ETag differs from the
+# one they would get when uploaded. Can also be enabled per run with
+# `s3up-dir --sync ...`.
 USE_DELTA_UPLOAD = False
 
-def should_upload_file(local_file_path, bucket, remote_file_path):
+# Where local file hashes are cached between runs, so unchanged files
+# don't have to be re-read to compare them to S3.
+MANIFEST_DIR = '~/.s3up/manifests'
+
+class HashCache(object):
+    """
+    Cached `s3up.local_etag` values for the files under `local_dir`, each
+    keyed by path and only trusted while the file's size and mtime match.
+    Everything is thrown out if the chunking options it was computed with
+    (which the ETag of a MultiPart upload depends on) have changed.
+    """
+    def __init__(self, local_dir):
+        self.path = os.path.join(
+            os.path.expanduser(MANIFEST_DIR),
+            hashlib.sha1(os.path.abspath(local_dir)).hexdigest() + '.json'
+        )
+        self.layout = [s3up.MULTIPART_THRESHOLD, s3up.CHUNK_SIZE]
+        self.files = {}
+        self.dirty = False
+        try:
+            with open(self.path, 'rb') as fp:
+                manifest = json.load(fp)
+            if manifest.get('layout') == self.layout:
+                self.files = manifest['files']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def etag(self, local_file):
+        fstat = os.stat(local_file)
+        entry = self.files.get(local_file)
+        if entry and entry[:2] == [fstat.st_size, fstat.st_mtime]:
+            return entry[2]
+        etag = s3up.local_etag(local_file)
+        self.files[local_file] = [fstat.st_size, fstat.st_mtime, etag]
+        self.dirty = True
+        return etag
+
+    def save(self):
+        if not self.dirty:
+            return
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path + '.tmp', 'wb') as fp:
+            json.dump({'layout': self.layout, 'files': self.files}, fp)
+        os.rename(self.path + '.tmp', self.path)
+        self.dirty = False
+
+def remote_etags(bucket_obj, prefix):
+    """
+    Returns `{key name: (etag, size)}` for every key under `prefix`, from a
+    (parallel) listing rather than a request per key.
+    """
+    remote = {}
+    for key in s3client.list_keys(bucket_obj, prefix,
+            s3up.LIST_PARALLELIZATION):
+        remote[key.name] = (key.etag.strip('"').strip("'"), key.size)
+    return remote
+
+def should_upload_file(local_file_path, remote_file_path, remote=None,
+        hashes=None):
     """
     Logic to handle skipping file uploads.
 
     * Skip temporary / cache-like files.
+    * With `remote` (see `remote_etags`) and `hashes` (a `HashCache`), skip
+      files that are already in S3 with the same size and ETag.
     """
     if not (
         (remote_file_path.find('.svn') == -1) and
@@ -66,31 +134,11 @@ def should_upload_file(local_file_path, bucket, remote_file_path):
     ):
         return False
 
-    # TODO
-    if USE_DELTA_UPLOAD:
-        s3 = S3Connection(
-            aws_access_key_id=s3up.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=s3up.AWS_SECRET_ACCESS_KEY,
-            host=s3up.S3_ENDPOINT
-        )
-        bucket_obj = s3.get_bucket(bucket)
-        key = bucket_obj.get_key(remote_file_path) or None
-        if key and getattr(key, 'etag', None):
-            local_hash = None
-            try:
-                with open(local_file_path, 'rb') as f_obj:
-                    local_hash = key.compute_md5(f_obj)
-            except:
-                pass
-            etag = key.etag.strip('"').strip("'")
-            print "local file: ", local_file_path
-            print "local hash: ", local_hash[0]
-            print "remote file: ", remote_file_path
-            print "remote etag: ", etag
-            if local_hash and (etag == local_hash[0]):
-                return False
-        else:
-            return True
+    if remote is not None and remote_file_path in remote:
+        etag, size = remote[remote_file_path]
+        if size == os.path.getsize(local_file_path) and \
+                etag == hashes.etag(local_file_path):
+            return False
 
     return True
 
@@ -98,39 +146,72 @@ def upload_dir(local_dir, remote_dir, bucket=None, bucket_url=None):
     if not bucket:
         bucket = s3up.AWS_DEFAULT_BUCKET
 
-    for root, dirs, files in os.walk(local_dir):
-        for f in files:
-            fullfile = os.path.join(root, f).strip()
-            remotefile = fullfile.replace(local_dir,'').strip()
-            if remote_dir:
-                remotefile = remote_dir+"/"+remotefile
-            if remotefile[0] == "/":
-                remotefile = remotefile[1:]
-            if should_upload_file(fullfile, bucket, remotefile):
-                if not USE_DELTA_UPLOAD:
-                    # cannot use multipart with deltas
-                    s3up.upload_file(fullfile, bucket, remotefile)
-                else:
-                    # TODO
-                    s3 = S3Connection(
-                        aws_access_key_id=s3up.AWS_ACCESS_KEY_ID,
-                        aws_secret_access_key=s3up.AWS_SECRET_ACCESS_KEY,
-                        host=s3up.S3_ENDPOINT
-                    )
-                    bucket_obj = s3.get_bucket(bucket)
-                    key = bucket_obj.get_key(remotefile) or bucket_obj.new_key(remotefile)
-                    key.set_contents_from_filename(fullfile,
-                        policy="public-read")
-                    key.make_public()
-                if not bucket_url:
-                    print "https://s3.amazonaws.com/%s/%s" % (bucket,remotefile)
+    bucket_obj = s3up.get_bucket(bucket)
+
+    # Every file (and every chunk of the larger ones) goes through one pool
+    # of `DIR_UPLOAD_PARALLELIZATION` workers, so lots of small files upload
+    # concurrently instead of one round trip at a time.
+    remote = None
+    hashes = None
+    if USE_DELTA_UPLOAD:
+        remote = remote_etags(bucket_obj, remote_dir)
+        hashes = HashCache(local_dir)
+
+    pool = s3up.UploadPool(s3up.DIR_UPLOAD_PARALLELIZATION)
+    progress = s3up.UploadProgress(local_dir, 0).start()
+    trackers = []
+    uploaded = []
+    try:
+        for root, dirs, files in os.walk(local_dir):
+            for f in files:
+                if pool.failed.is_set():
+                    break
+                fullfile = os.path.join(root, f).strip()
+                remotefile = fullfile.replace(local_dir,'').strip()
+                if remote_dir:
+                    remotefile = remote_dir+"/"+remotefile
+                if remotefile[0] == "/":
+                    remotefile = remotefile[1:]
+                if should_upload_file(fullfile, remotefile, remote, hashes):
+                    trackers.append(s3up.schedule_upload(
+                        pool, bucket_obj, fullfile, remotefile,
+                        progress=progress))
+                    uploaded.append(remotefile)
                 else:
-                    print "%s%s" % (bucket_url,remotefile)
-            else:
-                print "Skipped %s" % remotefile
+                    print "Skipped %s" % remotefile
+        pool.join()
+        progress.stop()
+    except:
+        progress.stop('failed')
+        sys.stderr.write("Exception! Waiting for existing uploads to stop.\n\n")
+        pool.failed.set()
+        pool.join(reraise=False)
+
+        # Remove already-uploaded chunks of files that didn't finish.
+        for tracker in trackers:
+            if tracker and not tracker.finished:
+                try:
+                    tracker.mp_key.cancel_upload()
+                except Exception:
+                    pass
+        raise
+    finally:
+        if hashes:
+            hashes.save()
+
+    for remotefile in uploaded:
+        if not bucket_url:
+            print "https://s3.amazonaws.com/%s/%s" % (bucket,remotefile)
+        else:
+            print "%s%s" % (bucket_url,remotefile)
 
 
 def main(args):
+    global USE_DELTA_UPLOAD
+    if "--sync" in args:
+        args.remove("--sync")
+        USE_DELTA_UPLOAD = True
+
     if len(args) == 2:
         local_dir = os.path.abspath(args[0])
         if not os.path.isdir(local_dir):
@@ -139,7 +220,7 @@ def main(args):
         upload_dir(local_dir,"files/"+args[1], s3up.AWS_DEFAULT_BUCKET, s3up.BUCKET_CNAME)
     else:
         print "Usage:"
-        print "s3up-dir local_directory remote_directory"
+        print "s3up-dir [--sync] local_directory remote_directory"
         sys.exit(1)
 
 if __name__ == '__main__':
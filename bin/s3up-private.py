@@ -25,6 +25,7 @@ limitations under the License.
 -----
 
 Requires boto: http://boto.cloudhackers.com/
+Relies on `s3client.py` and `s3up.py` in this directory.
 
 Usage:
 s3up-private filename [expiration_time]
@@ -39,6 +40,10 @@ s3up-private filename [expiration_time]
     in seconds. (Defaults to 3600 seconds). If set to 0, does not generate
     an access URL.
 
+    Files are uploaded the same way as by `s3up` (in parallel chunks, with
+    its UPLOAD_PARALLELIZATION, CHUNK_SIZE, RESUMABLE_UPLOADS etc. options),
+    and encrypted at rest by S3.
+
 Please set the following options below before using:
     AWS_ACCESS_KEY_ID (also accepted as an env var)
     AWS_SECRET_ACCESS_KEY (also accepted as an env var)
@@ -54,9 +59,10 @@ import hashlib
 import os
 import sys
 import traceback
-from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+import s3client
+import s3up
+from boto.s3.connection import OrdinaryCallingFormat
 from datetime import datetime
-from mimetypes import guess_type
 
 AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID', '')
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY', '')
@@ -94,16 +100,16 @@ if not (AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY):
 
 # ========== Uploader methods ==========
 
+def get_bucket(bucket_name):
+    return s3client.get_bucket(bucket_name, AWS_ACCESS_KEY_ID,
+        AWS_SECRET_ACCESS_KEY, S3_ENDPOINT, OrdinaryCallingFormat)
+
 def key_to_secure_url(key, bucket, link_expires):
-    s3 = S3Connection(
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        calling_format=OrdinaryCallingFormat(),
-        host=S3_ENDPOINT
-    )
-    bucket = s3.get_bucket(bucket)
-    k = bucket.get_key(key)
-    return k.generate_url(expires_in=link_expires)
+    # Signing is a local computation; no need to look the key up first.
+    connection = s3client.get_connection(AWS_ACCESS_KEY_ID,
+        AWS_SECRET_ACCESS_KEY, S3_ENDPOINT, OrdinaryCallingFormat)
+    return connection.generate_url(link_expires, 'GET', bucket=bucket,
+        key=key)
 
 def hashed_filename(remote_path):
     filebase, fileext = os.path.splitext(os.path.basename(remote_path))
@@ -134,21 +140,11 @@ def easy_up(local_file, link_expires=DEFAULT_EXPIRES):
         print("Path given is not a file.", file=sys.stderr)
 
 def upload_file(local_file, bucket, remote_path):
-    s3 = S3Connection(
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        calling_format=OrdinaryCallingFormat(),
-        host=S3_ENDPOINT
-    )
-    bucket = s3.get_bucket(bucket)
-    key = bucket.new_key(remote_path)
-    key.content_type = guess_type(local_file, False)[0] or "application/octet-stream"
-    key.set_contents_from_filename(local_file, policy="private", encrypt_key=True)
-
-    # ===== / chunked upload =====
-
-    key.set_metadata('Cache-Control','no-cache, no-store')
-    key.set_canned_acl("private")
+    # Private ACL, encryption and metadata (Content-Type, and no caching) are
+    # all set when the upload is started, so the key is never visible
+    # without them.
+    s3up.upload_file(local_file, get_bucket(bucket), remote_path, 0,
+        policy="private", encrypt_key=True)
 
 
 def main(args):
@@ -23,6 +23,7 @@ limitations under the License.
 -----
 
 Requires boto: http://boto.cloudhackers.com/
+Relies on `s3client.py` in this directory.
 
 Usage:
   s3up filename
@@ -37,6 +38,32 @@ Usage:
   s3up filename [bucket] [remote_filename] [cache_time]
   s3up filename [bucket] [remote_filename] [cache_time] [policy]
 
+  s3up - [bucket] [remote_filename] ...
+    Uploads whatever is piped into stdin (also works with a named pipe
+    in place of the filename), e.g.:
+        tar -c dir | xz | s3up - my-bucket backups/dir.tar.xz
+
+  s3up --adaptive ...
+    Any of the above, tuning UPLOAD_PARALLELIZATION and CHUNK_SIZE to the
+    observed throughput while uploading (see ADAPTIVE_UPLOAD).
+
+  s3up --resume ...
+    Any of the above, keeping uploaded chunks if the upload fails so that
+    running the same command again only uploads the missing ones
+    (see RESUMABLE_UPLOADS).
+
+  s3up --limit-rate=RATE ...
+    Any of the above, uploading no faster than RATE bytes/second (a K, M
+    or G suffix is allowed) in total (see MAX_UPLOAD_RATE).
+
+  s3up --progress=MODE ...
+    Any of the above, reporting progress as a progress bar (MODE "bar"),
+    JSON lines ("json") or both ("both"); see PROGRESS.
+
+  s3up --sha256 ...
+    Any of the above, also computing a SHA-256 of every chunk and printing
+    their composite once uploaded (see CHECKSUM_SHA256).
+
 
 Please double-check and set the following options below before using:
   AWS_ACCESS_KEY_ID (also accepted as an env var)
@@ -46,20 +73,28 @@ Please double-check and set the following options below before using:
   UPLOAD_PARALLELIZATION
   CHUNK_SIZE
   CHUNK_RETRIES
+  ADAPTIVE_UPLOAD
+  RESUMABLE_UPLOADS
 (Note, you can also set these in `dotfiles_config.py` -- see example file.
 That file overrides identical AWS_* environment variables.)
 """
 from __future__ import print_function
+import base64
+import hashlib
+import json
 import os
+import stat
 import sys
 import traceback
-from boto.s3.connection import S3Connection
-from cStringIO import StringIO
+import s3client
+from boto.exception import S3ResponseError
+from boto.s3.multipart import MultiPartUpload
 from datetime import datetime
 from math import ceil, floor
 from mimetypes import guess_type
-from threading import Thread
-from time import sleep
+from Queue import Queue
+from threading import Condition, Event, Lock, Thread
+from time import time
 
 AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID', '')
 AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY', '')
@@ -85,6 +120,10 @@ BUCKET_CNAME = None
 # Number of simultaneous upload threads to execute.
 UPLOAD_PARALLELIZATION = 4
 
+# Files smaller than this are uploaded with a single PUT instead of a
+# MultiPart upload. Defaults to `CHUNK_SIZE`.
+MULTIPART_THRESHOLD = None
+
 # Default size for a file chunk (excluding final chunk). A file will need
 # to be larger than this size to enable parallelized upload. (Since S3
 # only supports 10,000 chunks, extremely large files will automatically
@@ -95,13 +134,76 @@ CHUNK_SIZE = 5242880
 # For robustness, we can retry uploading any chunk up to this many times. (Set
 # to 1 or less to only attempt one upload per chunk.) Because we chunk large
 # uploads, an error in a single chunk doesn't necessarily mean we need to
-# re-upload the entire file.
+# re-upload the entire file. Retries back off with random jitter, all upload
+# threads slow down together when S3 throttles us, and errors that can't be
+# fixed by retrying (e.g. 403 Forbidden) aren't retried. See `s3client`.
 CHUNK_RETRIES = 10
 
+# Adaptive mode: instead of fixed `UPLOAD_PARALLELIZATION` and `CHUNK_SIZE`,
+# measure throughput while uploading and grow or shrink the number of parts
+# in flight (up to `MAX_UPLOAD_PARALLELIZATION`) and the size of parts not
+# yet cut (up to `MAX_CHUNK_SIZE`), starting from the values above. Can also
+# be enabled per run with `s3up --adaptive ...`.
+ADAPTIVE_UPLOAD = False
+MAX_UPLOAD_PARALLELIZATION = 32
+MAX_CHUNK_SIZE = 268435456
+
+# Number of simultaneous upload threads that `s3up-dir` shares between all of
+# the files (and file chunks) it uploads.
+DIR_UPLOAD_PARALLELIZATION = 16
+
+# Number of simultaneous ranged GETs per download in `s3down`. Defaults to
+# `UPLOAD_PARALLELIZATION`.
+DOWNLOAD_PARALLELIZATION = None
+
+# Number of threads listing a bucket at once, one "directory" (prefix up to a
+# "/") each, when `s3up-dir --sync` and `s3search` list large buckets.
+LIST_PARALLELIZATION = 16
+
+# Resumable mode: instead of cancelling the whole upload when a chunk fails,
+# leave the uploaded parts on the server and record their ETags in a journal
+# under `JOURNAL_DIR`. Running the same upload again picks up where it left
+# off. Can also be enabled per run with `s3up --resume ...`.
+RESUMABLE_UPLOADS = False
+JOURNAL_DIR = '~/.s3up/journal'
+
+# Every chunk is hashed as it is read and sent with its MD5 (Content-MD5), and
+# the ETag of the finished upload is checked against those MD5s. Setting this
+# also computes a SHA-256 of every chunk in the same read, recorded in the
+# resume journal and printed (as a composite, like the ETag) once uploaded.
+# Can also be enabled per run with `s3up --sha256 ...`.
+CHECKSUM_SHA256 = False
+
+# Caps the combined rate of all upload threads at this many bytes/second (None
+# for no cap). `UPLOAD_RATE_SCHEDULE` sets different caps for parts of the
+# day, as a list of ("HH:MM", "HH:MM", rate) windows in local time; the first
+# one that matches wins, and a window may wrap past midnight. For example, to
+# keep backups from starving other traffic during business hours:
+#   UPLOAD_RATE_SCHEDULE = [("09:00", "18:00", 1048576)]
+# Can also be set per run (overriding both) with `s3up --limit-rate=RATE ...`.
+MAX_UPLOAD_RATE = None
+UPLOAD_RATE_SCHEDULE = []
+
+# Progress reporting while uploading. "bar" redraws a progress bar on stderr,
+# "json" writes a line of JSON metrics (bytes sent, parts in flight, part
+# latencies, retries, rate and ETA) to `PROGRESS_LOG` (default: stderr) every
+# `PROGRESS_INTERVAL` seconds, "both" does both and "none" neither. "auto"
+# draws a bar if stderr is a terminal. Can also be set per run with
+# `s3up --progress=MODE ...`.
+PROGRESS = 'auto'
+PROGRESS_LOG = None
+PROGRESS_INTERVAL = 1.0
+
 # Load/override options from optional `dotfiles_config.py` file.
 OPTIONS = set(['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY',
     'AWS_DEFAULT_BUCKET', 'S3_ENDPOINT', 'BUCKET_CNAME',
-    'UPLOAD_PARALLELIZATION', 'CHUNK_SIZE', 'CHUNK_RETRIES'])
+    'UPLOAD_PARALLELIZATION', 'CHUNK_SIZE', 'CHUNK_RETRIES',
+    'ADAPTIVE_UPLOAD', 'MAX_UPLOAD_PARALLELIZATION', 'MAX_CHUNK_SIZE',
+    'DIR_UPLOAD_PARALLELIZATION', 'DOWNLOAD_PARALLELIZATION',
+    'LIST_PARALLELIZATION',
+    'RESUMABLE_UPLOADS', 'JOURNAL_DIR',
+    'MULTIPART_THRESHOLD', 'CHECKSUM_SHA256', 'MAX_UPLOAD_RATE',
+    'UPLOAD_RATE_SCHEDULE', 'PROGRESS', 'PROGRESS_LOG', 'PROGRESS_INTERVAL'])
 for option in OPTIONS:
     try:
         _cfg = __import__('dotfiles_config', globals(), locals(), [option,], -1)
@@ -111,6 +213,11 @@ for option in OPTIONS:
     except:
         pass
 
+if MULTIPART_THRESHOLD is None:
+    MULTIPART_THRESHOLD = CHUNK_SIZE
+if DOWNLOAD_PARALLELIZATION is None:
+    DOWNLOAD_PARALLELIZATION = UPLOAD_PARALLELIZATION
+
 if not (AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY):
     configfile = os.path.join(
         os.path.abspath(os.path.dirname(__file__)),
@@ -122,83 +229,1065 @@ if not (AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY):
     print("    %s" % configfile, file=sys.stderr)
     sys.exit(1)
 
+def get_bucket(bucket_name):
+    """
+    Returns a (shared, cached) handle for `bucket_name`. See `s3client`.
+    """
+    return s3client.get_bucket(bucket_name, AWS_ACCESS_KEY_ID,
+        AWS_SECRET_ACCESS_KEY, S3_ENDPOINT)
+
+
 # ========== "MultiPart" (chunked) upload utility methods ==========
 
-def mem_chunk_file(local_file):
+# S3 limits: every part except the last must be at least 5MB, and an upload
+# may have at most 10,000 parts.
+MIN_CHUNK_SIZE = 5242880
+MAX_CHUNKS = 10000
+
+class FileChunk(object):
     """
-    Given the file at `local_file`, returns a generator of CHUNK_SIZE
-    (default 5MB) StringIO file-like chunks for that file.
+    A read-only, seekable, file-like view over `size` bytes of `path`
+    starting at `offset`. Nothing is buffered: the file is opened on first
+    read and every read goes straight to (usually) the page cache, so a queued
+    chunk costs no memory and a retried chunk is simply re-read.
     """
-    fstat = os.stat(local_file)
-    fsize = fstat.st_size
+    def __init__(self, path, offset, size):
+        self.path = path
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+        self.fp = None
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        remaining = self.size - self.pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return ''
+        if self.fp is None:
+            self.fp = open(self.path, 'rb')
+        self.fp.seek(self.offset + self.pos)
+        data = self.fp.read(size)
+        self.pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = min(max(offset, 0), self.size)
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
 
+
+def chunk_layout(fsize):
+    """
+    Returns `(chunk_size, num_chunks)` for a file of `fsize` bytes. Every
+    chunk is `chunk_size` long except the last one, which also takes the
+    remainder.
+    """
     chunk_size = CHUNK_SIZE
     num_chunks = max(int(floor(float(fsize) / float(chunk_size))), 1)
-    if num_chunks > 10000:
+    if num_chunks > MAX_CHUNKS:
         # File would require too many chunks. Make each chunk larger instead.
-        chunk_size = int(ceil(float(fsize) / 10000.0))
+        chunk_size = int(ceil(float(fsize) / float(MAX_CHUNKS)))
         chunk_size = int(1024.0 * ceil(chunk_size / 1024.0))  # round up to nearest 1KB
         num_chunks = int(ceil(float(fsize) / float(chunk_size)))
+    return chunk_size, num_chunks
+
+
+def file_chunks(local_file):
+    """
+    Given the file at `local_file`, returns a generator of CHUNK_SIZE
+    (default 5MB) `FileChunk` views over that file.
+    """
+    fsize = os.stat(local_file).st_size
+    chunk_size, num_chunks = chunk_layout(fsize)
 
-    fp = open(local_file, 'rb')
     for i in range(num_chunks):
-        tfp = StringIO()
         if i == (num_chunks - 1):
             # remaining data
             size_hint = fsize - (chunk_size * (num_chunks - 1))
         else:
             size_hint = chunk_size
+        yield FileChunk(local_file, chunk_size * i, size_hint)
 
-        tfp.write(fp.read(size_hint))
-        tfp.seek(0)
-        yield tfp
-    fp.close()
+
+def chunk_digests(fp, sha256=False):
+    """
+    Reads the chunk `fp` through once, returning `(md5, sha256)` hashlib
+    objects for it (`sha256` is None unless asked for). Leaves `fp` rewound.
+    """
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256() if sha256 else None
+    fp.seek(0)
+    while True:
+        data = fp.read(1048576)
+        if not data:
+            break
+        md5.update(data)
+        if sha256:
+            sha256.update(data)
+    fp.seek(0)
+    return md5, sha256
 
 
-def upload_worker(multipart_key, fp, index, headers=None):
+class PartDigests(object):
     """
-    Uploads a file chunk in a MultiPart S3 upload. If an error occurs uploading
-    this chunk, retry up to `CHUNK_RETRIES` times.
+    The MD5 (and optionally SHA-256) digests of the parts of one multipart
+    upload, filled in by `upload_worker` (or from the journal of a resumed
+    upload), from which the ETag of the finished upload can be predicted.
+    """
+    def __init__(self):
+        self.md5 = {}
+        self.sha256 = {}
+
+    def add(self, index, md5, sha256=None):
+        self.md5[index] = md5
+        if sha256:
+            self.sha256[index] = sha256
+
+    @staticmethod
+    def _composite(hasher, digests):
+        return "%s-%d" % (
+            hasher("".join(digests[i] for i in sorted(digests))).hexdigest(),
+            len(digests)
+        )
+
+    def etag(self):
+        """
+        The ETag S3 computes for the completed upload: the MD5 of the
+        concatenated (binary) part MD5s, followed by "-" and the number of
+        parts.
+        """
+        return self._composite(hashlib.md5, self.md5)
+
+    def sha256_composite(self):
+        """
+        The same for SHA-256, or None if not every part has a SHA-256.
+        """
+        if not self.sha256 or len(self.sha256) != len(self.md5):
+            return None
+        return self._composite(hashlib.sha256, self.sha256)
+
+    def verify(self, remote_path, etag):
+        """
+        Raises if `etag`, as reported by S3 for the completed upload, isn't
+        the one our parts add up to.
+        """
+        etag = (etag or '').strip('"')
+        if etag != self.etag():
+            raise Exception("%s was uploaded with ETag %s, but its chunks add "
+                "up to %s; the uploaded object does not match the local data."
+                % (remote_path, etag, self.etag()))
+
+
+def local_etag(local_file):
+    """
+    Computes the ETag S3 will report for `local_file` once uploaded by
+    `upload_file` or `schedule_upload`: the MD5 of a file sent with a single
+    PUT, or for a MultiPart upload, the MD5 of the concatenated (binary) MD5s
+    of its `file_chunks`, followed by "-" and the number of chunks.
+    """
+    fsize = os.stat(local_file).st_size
+    single_put = fsize < MULTIPART_THRESHOLD
+    if single_put:
+        chunks = [FileChunk(local_file, 0, fsize)]
+    else:
+        chunks = list(file_chunks(local_file))
+
+    digests = PartDigests()
+    for i, chunk in enumerate(chunks):
+        md5 = chunk_digests(chunk)[0]
+        chunk.close()
+        if single_put:
+            return md5.hexdigest()
+        digests.add(i + 1, md5.digest())
+    return digests.etag()
+
+
+def adaptive_file_chunks(local_file, tuner):
+    """
+    Like `file_chunks`, but each chunk is only cut when it is about to be
+    uploaded, using the current `tuner.chunk_size`. Chunks are never smaller
+    than `MIN_CHUNK_SIZE` (except the last one) and are grown when needed to
+    fit the rest of the file into the remaining `MAX_CHUNKS` parts.
+    """
+    fsize = os.stat(local_file).st_size
+    offset = 0
+    index = 0
+    while offset < fsize or index == 0:
+        remaining = fsize - offset
+        chunk_size = max(
+            tuner.chunk_size,
+            int(1024 * ceil(remaining / 1024.0 / (MAX_CHUNKS - index)))
+        )
+        if remaining - chunk_size < MIN_CHUNK_SIZE:
+            # Same as `file_chunks`: the last chunk takes the remainder.
+            chunk_size = remaining
+        yield FileChunk(local_file, offset, chunk_size)
+        offset += chunk_size
+        index += 1
+
+
+class BufferChunk(object):
+    """
+    A file-like chunk holding data read from a stream, for sources that
+    can't be re-read (see `stream_chunks`).
+    """
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = len(self.data)
+        else:
+            end = min(self.pos + size, len(self.data))
+        data = self.data[self.pos:end]
+        self.pos = end
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += len(self.data)
+        self.pos = min(max(offset, 0), len(self.data))
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        pass
+
+
+def is_stream(local_file):
+    """
+    True if `local_file` is `-` (stdin) or a pipe, i.e. something with no
+    known size that can only be read once.
+    """
+    if local_file == '-':
+        return True
+    try:
+        return stat.S_ISFIFO(os.stat(local_file).st_mode)
+    except OSError:
+        return False
+
+
+def stream_chunk_size(index):
+    """
+    Size of chunk number `index` (zero-based) of a stream. Since we don't
+    know how long the stream is, chunks start at `CHUNK_SIZE` and double
+    every 1,000 parts, which fits up to S3's 5TB object limit into
+    `MAX_CHUNKS` parts.
+    """
+    return max(CHUNK_SIZE, MIN_CHUNK_SIZE) * 2 ** (index // 1000)
+
+
+def stream_chunks(local_file, tuner=None):
+    """
+    Given `-` (stdin) or a pipe at `local_file`, returns a generator of
+    `BufferChunk` chunks read from it, as sized by `stream_chunk_size` (or
+    larger, if `tuner` asks for it).
+
+    Each chunk is only read when the previous one has been handed off, so
+    at most one chunk beyond those being uploaded is buffered, and whatever
+    is writing into the pipe keeps running while we upload.
+    """
+    if local_file == '-':
+        fp = sys.stdin
+    else:
+        fp = open(local_file, 'rb')
+
+    index = 0
+    while True:
+        chunk_size = stream_chunk_size(index)
+        if tuner:
+            chunk_size = max(chunk_size, tuner.chunk_size)
+        data = fp.read(chunk_size)
+        if not data and index > 0:
+            break
+        yield BufferChunk(data)
+        index += 1
+        if len(data) < chunk_size:
+            break
+
+    if fp is not sys.stdin:
+        fp.close()
+
+
+class UploadJournal(object):
     """
-    success = False
-    attempts = 0
-    while not success:
+    On-disk record of a resumable multipart upload, kept in `JOURNAL_DIR`.
+    The first line is a JSON header identifying the upload and the source
+    file it was started from; every following line records one completed
+    part as `{"part": n, "etag": "..."}` (plus its hex `"sha256"` with
+    `CHECKSUM_SHA256`). Lines are only ever appended, so a crash can at worst
+    lose the last part.
+    """
+    def __init__(self, local_file, bucket, remote_path):
+        name = "%s\n%s\n%s" % (os.path.abspath(local_file), bucket, remote_path)
+        self.path = os.path.join(
+            os.path.expanduser(JOURNAL_DIR),
+            hashlib.sha1(name).hexdigest() + '.json'
+        )
+        self.header = None
+        self.parts = {}
+        self.sha256 = {}
+        self.lock = Lock()
+        self.fp = None
+
         try:
-            fp.seek(0)
-            multipart_key.upload_part_from_file(fp, index, headers=headers)
-        except (KeyboardInterrupt, SystemExit):
-            raise
-        except:
-            success = False
+            with open(self.path, 'rb') as fp:
+                lines = fp.readlines()
+        except IOError:
+            return
+        try:
+            self.header = json.loads(lines[0])
+            for line in lines[1:]:
+                part = json.loads(line)
+                self.parts[part['part']] = part['etag']
+                if part.get('sha256'):
+                    self.sha256[part['part']] = part['sha256']
+        except (IndexError, ValueError, KeyError):
+            # Unreadable or cut short while writing; keep what we got.
+            pass
 
-            attempts += 1
-            if attempts >= CHUNK_RETRIES:
-                break
+    def start(self, header):
+        """
+        Starts a new journal (discarding any old one) for the upload
+        described by `header`, which must include the `upload_id`.
+        """
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        self.close()
+        self.header = header
+        self.parts = {}
+        self.sha256 = {}
+        self.fp = open(self.path, 'wb')
+        self.fp.write(json.dumps(header) + '\n')
+        self.fp.flush()
+
+    def record(self, index, etag, sha256=None):
+        line = {'part': index, 'etag': etag}
+        if sha256:
+            line['sha256'] = sha256
+        with self.lock:
+            if self.fp is None:
+                self.fp = open(self.path, 'ab')
+            self.parts[index] = etag
+            if sha256:
+                self.sha256[index] = sha256
+            self.fp.write(json.dumps(line) + '\n')
+            self.fp.flush()
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
 
-            sleep(0.5)
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def resume_multipart_upload(bucket, remote_path, journal, header, chunk_sizes):
+    """
+    Looks up the multipart upload recorded in `journal`, if it was started
+    for the same source file (same `header`) and is still in progress on the
+    server. Returns `(multipart_key, done)`, where `done` is the set of part
+    numbers already on the server with the size and ETag we expect, or
+    `(None, set())` if there is nothing to resume.
+
+    `chunk_sizes` lists the expected size of every part, in order.
+    """
+    old = journal.header or {}
+    upload_id = old.get('upload_id')
+    if not upload_id:
+        return None, set()
+
+    mp_key = MultiPartUpload(bucket)
+    mp_key.key_name = remote_path
+    mp_key.id = upload_id
+
+    if dict(old, upload_id=None) != dict(header, upload_id=None):
+        # The local file changed since; its parts are no good to us.
+        sys.stderr.write("Source file changed since the interrupted upload; " \
+            "starting over.\n")
+        try:
+            mp_key.cancel_upload()
+        except S3ResponseError:
+            pass
+        return None, set()
+
+    try:
+        server_parts = list(mp_key)
+    except S3ResponseError, e:
+        if e.status == 404:
+            # Completed or cancelled in the meantime.
+            return None, set()
+        raise
+
+    done = set()
+    for part in server_parts:
+        index = part.part_number
+        if (index <= len(chunk_sizes) and
+                part.size == chunk_sizes[index - 1] and
+                part.etag == journal.parts.get(index)):
+            done.add(index)
+
+    sys.stderr.write("Resuming upload %s: %d of %d parts already uploaded.\n"
+        % (upload_id, len(done), len(chunk_sizes)))
+    return mp_key, done
+
+
+class ThroughputTuner(object):
+    """
+    Tunes an `UploadPool` while an upload is running. After every window of
+    completed parts it compares throughput to the previous window and keeps
+    stepping the number of parts in flight in whichever direction helped
+    (hill climbing). Retries or parts slower than `SLOW_PART_SECONDS` halve
+    both concurrency and part size. Part size otherwise tracks the observed
+    per-connection bandwidth, aiming for parts that take `PART_SECONDS`.
+    """
+    PART_SECONDS = 10.0
+    SLOW_PART_SECONDS = 60.0
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.chunk_size = max(CHUNK_SIZE, MIN_CHUNK_SIZE)
+        self.direction = 1
+        self.last_throughput = None
+        self.lock = Lock()
+        self._reset_window()
+
+    def _reset_window(self):
+        self.window_start = time()
+        self.window_bytes = 0
+        self.window_parts = 0
+        self.window_slow = False
+
+    def record(self, nbytes, seconds, retries):
+        with self.lock:
+            self.window_bytes += nbytes
+            self.window_parts += 1
+            if retries or seconds > self.SLOW_PART_SECONDS:
+                self.window_slow = True
+            if self.window_parts >= max(self.pool.limit, 2):
+                self._adjust()
+
+    def _adjust(self):
+        limit = self.pool.limit
+        elapsed = max(time() - self.window_start, 0.001)
+        throughput = self.window_bytes / elapsed
+
+        if self.window_slow:
+            limit = max(limit // 2, 1)
+            self.chunk_size = max(self.chunk_size // 2, MIN_CHUNK_SIZE)
+            self.direction = 1
+            self.last_throughput = None
         else:
-            success = True
+            if self.last_throughput is not None:
+                if throughput < self.last_throughput * 0.95:
+                    self.direction = -self.direction or -1
+                elif throughput < self.last_throughput * 1.05:
+                    self.direction = 0 if self.direction else 1
+            limit += self.direction
+            self.last_throughput = throughput
 
-    if not success:
-        raise Exception("Upload of chunk %d failed after 5 retries." % index)
+            # Move halfway towards a part size that one connection can send
+            # in `PART_SECONDS`, rounded to whole megabytes.
+            target = throughput / limit * self.PART_SECONDS
+            target = (self.chunk_size + target) / 2
+            target = int(1048576 * ceil(target / 1048576.0))
+            self.chunk_size = min(max(target, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
 
-    fp.close()
+        self.pool.set_limit(min(max(limit, 1), MAX_UPLOAD_PARALLELIZATION))
+        self._reset_window()
 
 
-def upload_chunk(arg_list):
-    thread = Thread(
-        target=upload_worker,
-        args=arg_list
-    )
-    thread.daemon = False
-    thread.start()
-    return thread
+_retry_policy = None
+
+def get_retry_policy():
+    """
+    Returns the `s3client.RetryPolicy` shared by all uploads in this process,
+    allowing up to `CHUNK_RETRIES` attempts per request.
+    """
+    global _retry_policy
+    if _retry_policy is None:
+        _retry_policy = s3client.RetryPolicy(CHUNK_RETRIES)
+    return _retry_policy
+
+
+def scheduled_upload_rate(now=None):
+    """
+    Returns the upload rate cap (in bytes/second, or None) that applies at
+    `now` (default: the current local time), from `UPLOAD_RATE_SCHEDULE` or
+    otherwise `MAX_UPLOAD_RATE`.
+    """
+    now = (now or datetime.now()).strftime("%H:%M")
+    for start, end, rate in UPLOAD_RATE_SCHEDULE:
+        if start <= end:
+            active = start <= now < end
+        else:
+            active = now >= start or now < end
+        if active:
+            return rate
+    return MAX_UPLOAD_RATE
+
+
+def parse_rate(rate):
+    """
+    Parses a rate like `500K` or `2M` (bytes/second, with 1K = 1024).
+    """
+    rate = rate.strip().upper()
+    multiplier = 1
+    for i, suffix in enumerate("KMG"):
+        if rate.endswith(suffix):
+            rate = rate[:-1]
+            multiplier = 1024 ** (i + 1)
+    return int(float(rate) * multiplier)
+
+
+class BandwidthLimiter(object):
+    """
+    Paces the data sent by all upload threads to `scheduled_upload_rate`,
+    through one shared `s3client.TokenBucket`. Threads take tokens for every
+    block they send, and the bucket only saves up `BURST_SECONDS` worth of
+    tokens, so the link sees a steady rate rather than bursts. The schedule
+    is checked again every `CHECK_SECONDS`.
+    """
+    BURST_SECONDS = 0.1
+    CHECK_SECONDS = 60.0
+
+    def __init__(self):
+        self.bucket = s3client.TokenBucket()
+        self.checked = None
+
+    def consume(self, nbytes):
+        now = time()
+        if self.checked is None or now - self.checked >= self.CHECK_SECONDS:
+            self.checked = now
+            rate = scheduled_upload_rate()
+            if rate != self.bucket.rate:
+                self.bucket.set_rate(rate,
+                    rate and max(rate * self.BURST_SECONDS, 65536))
+        self.bucket.consume(nbytes)
+
+
+_bandwidth_limiter = None
+
+def get_bandwidth_limiter():
+    """
+    Returns the `BandwidthLimiter` shared by all uploads in this process.
+    """
+    global _bandwidth_limiter
+    if _bandwidth_limiter is None:
+        _bandwidth_limiter = BandwidthLimiter()
+    return _bandwidth_limiter
+
+
+class LimitedChunk(object):
+    """
+    Wraps a chunk (see `FileChunk`) so that reading it, i.e. sending it,
+    goes through `get_bandwidth_limiter`, and is counted by `progress` (an
+    `UploadProgress`) if given. Data read again (by a retry) isn't counted
+    twice.
+    """
+    def __init__(self, chunk, progress=None):
+        self.chunk = chunk
+        self.limiter = get_bandwidth_limiter()
+        self.progress = progress
+        self.sent = 0
+
+    def __len__(self):
+        return len(self.chunk)
+
+    def read(self, size=-1):
+        data = self.chunk.read(size)
+        if data:
+            self.limiter.consume(len(data))
+            if self.progress and self.chunk.tell() > self.sent:
+                self.progress.add_bytes(self.chunk.tell() - self.sent)
+                self.sent = self.chunk.tell()
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.chunk.seek(offset, whence)
+
+    def tell(self):
+        return self.chunk.tell()
+
+    def close(self):
+        self.chunk.close()
+
+
+# ========== Progress reporting ==========
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def format_size(nbytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(nbytes) < 1024.0:
+            break
+        nbytes /= 1024.0
+    else:
+        unit = 'TB'
+    return "%.1f%s" % (nbytes, unit)
+
+
+class UploadProgress(object):
+    """
+    Live metrics for an upload (or a whole `s3up-dir` run): bytes sent, parts
+    in flight and done, part latencies and retries. Workers only bump a few
+    counters (see `LimitedChunk` and `upload_worker`); a background thread
+    started by `start` reports them every `PROGRESS_INTERVAL` seconds as a
+    progress bar and/or JSON lines, per `mode` (see `PROGRESS`).
+
+    `total` is the number of bytes to upload, if known; `add_total` raises
+    it as more files are queued.
+    """
+    def __init__(self, name, total=None, mode=None):
+        mode = mode or PROGRESS
+        if mode == 'auto':
+            mode = 'bar' if sys.stderr.isatty() else 'none'
+        self.bar = mode in ('bar', 'both')
+        self.json = mode in ('json', 'both')
+        self.name = name
+        self.total = total
+        self.sent = 0
+        self.parts_done = 0
+        self.in_flight = 0
+        self.retries = 0
+        self.latencies = []
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+        self.start_time = time()
+        self.last = (self.start_time, 0)
+        self.log = None
+
+    def add_total(self, nbytes):
+        with self.lock:
+            self.total = (self.total or 0) + nbytes
+
+    def add_bytes(self, nbytes):
+        with self.lock:
+            self.sent += nbytes
+
+    def part_started(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def part_finished(self, seconds, retries, ok=True):
+        with self.lock:
+            self.in_flight -= 1
+            self.retries += retries
+            if ok:
+                self.parts_done += 1
+                self.latencies.append(seconds)
+
+    def snapshot(self):
+        """
+        Returns the current metrics as a dict.
+        """
+        now = time()
+        with self.lock:
+            sent, total = self.sent, self.total
+            latencies = list(self.latencies)
+            metrics = {
+                'name': self.name,
+                'time': now,
+                'elapsed': round(now - self.start_time, 3),
+                'bytes_sent': sent,
+                'bytes_total': total,
+                'parts_done': self.parts_done,
+                'parts_in_flight': self.in_flight,
+                'retries': self.retries,
+            }
+        last_time, last_sent = self.last
+        self.last = (now, sent)
+        rate = (sent - last_sent) / max(now - last_time, 0.001)
+        average = sent / max(now - self.start_time, 0.001)
+        metrics['rate'] = int(rate)
+        metrics['eta'] = None
+        if total is not None and average > 0:
+            metrics['eta'] = round(max(total - sent, 0) / average, 1)
+        metrics['part_seconds_p50'] = percentile(latencies, 0.5)
+        metrics['part_seconds_p90'] = percentile(latencies, 0.9)
+        metrics['part_seconds_max'] = latencies and max(latencies) or None
+        return metrics
+
+    def render_bar(self, metrics, width=30):
+        sent, total = metrics['bytes_sent'], metrics['bytes_total']
+        if total:
+            done = min(float(sent) / total, 1.0)
+            bar = "[%s%s] %3d%% %s/%s" % ('#' * int(done * width),
+                '-' * (width - int(done * width)), done * 100,
+                format_size(sent), format_size(total))
+        else:
+            bar = format_size(sent)
+        bar += "  %s/s  %d in flight" % (format_size(metrics['rate']),
+            metrics['parts_in_flight'])
+        if metrics['retries']:
+            bar += ", %d retries" % metrics['retries']
+        if metrics['eta'] is not None:
+            eta = int(metrics['eta'])
+            bar += "  ETA %d:%02d:%02d" % (eta // 3600, eta // 60 % 60, eta % 60)
+        return bar
+
+    def report(self, status='uploading'):
+        metrics = self.snapshot()
+        metrics['status'] = status
+        if self.json:
+            line = json.dumps(metrics) + '\n'
+            if self.log is sys.stderr and self.bar:
+                line = '\r\x1b[K' + line
+            self.log.write(line)
+            self.log.flush()
+        if self.bar:
+            sys.stderr.write('\r\x1b[K' + self.render_bar(metrics))
+            if status != 'uploading':
+                sys.stderr.write('\n')
+            sys.stderr.flush()
+
+    def _run(self):
+        while not self.stopped.wait(PROGRESS_INTERVAL):
+            self.report()
+
+    def start(self):
+        if not (self.bar or self.json):
+            return self
+        if self.json:
+            if PROGRESS_LOG:
+                self.log = open(os.path.expanduser(PROGRESS_LOG), 'ab')
+            else:
+                self.log = sys.stderr
+        self.thread = Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self, status='done'):
+        """
+        Stops reporting, after a final report with the given `status`.
+        """
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        self.report(status)
+        if self.log is not sys.stderr:
+            self.log.close()
+
+
+def upload_worker(multipart_key, fp, index, headers=None, tuner=None,
+        journal=None, digests=None, progress=None):
+    """
+    Uploads a file chunk in a MultiPart S3 upload. If an error occurs uploading
+    this chunk, it is retried as `get_retry_policy` sees fit.
+
+    The chunk is hashed once up front and sent with its MD5, so boto doesn't
+    hash it again on every attempt and S3 rejects it if it arrives damaged.
+    A part whose ETag doesn't match that MD5 is retried as well.
+
+    If given, the part's size and timing are reported to `tuner`, its ETag
+    is recorded in `journal` and its digests in `digests` (a `PartDigests`)
+    once it is uploaded, and `progress` (an `UploadProgress`) is kept up to
+    date as it goes.
+    """
+    attempts = [0]
+    start = time()
+    body = LimitedChunk(fp, progress)
+    if progress:
+        progress.part_started()
+
+    def attempt():
+        attempts[0] += 1
+        body.seek(0)
+        part = multipart_key.upload_part_from_file(body, index,
+            headers=headers,
+            md5=(md5.hexdigest(), base64.b64encode(md5.digest())),
+            size=len(fp))
+        etag = getattr(part, 'etag', None)
+        if etag and etag.strip('"') != md5.hexdigest():
+            raise IOError("S3 reports ETag %s for chunk %d, expected \"%s\""
+                % (etag, index, md5.hexdigest()))
+        return part
+
+    ok = False
+    try:
+        md5, sha256 = chunk_digests(fp, CHECKSUM_SHA256)
+        part = get_retry_policy().call(attempt)
+        ok = True
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except Exception, e:
+        raise Exception("Upload of chunk %d failed after %d attempt(s): %r"
+            % (index, attempts[0], e))
+    finally:
+        fp.close()
+        if progress:
+            progress.part_finished(time() - start, max(attempts[0] - 1, 0),
+                ok)
+
+    if tuner:
+        tuner.record(len(fp), time() - start, attempts[0] - 1)
+    if digests is not None:
+        digests.add(index, md5.digest(), sha256 and sha256.digest())
+    if journal and getattr(part, 'etag', None):
+        journal.record(index, part.etag, sha256 and sha256.hexdigest())
+
+
+def complete_upload(mp_key, digests=None):
+    """
+    Completes the multipart upload `mp_key`, retrying as needed. Given the
+    `PartDigests` of all of its parts, also checks the ETag S3 reports for
+    the completed object against them.
+    """
+    completed = get_retry_policy().call(mp_key.complete_upload)
+    if digests is not None:
+        digests.verify(mp_key.key_name, getattr(completed, 'etag', None))
+    return completed
+
+
+class UploadPool(object):
+    """
+    A fixed set of `UPLOAD_PARALLELIZATION` worker threads that pull jobs
+    off a bounded queue, so the next chunk starts uploading the moment a
+    worker frees up. The first job to raise sets the `failed` event; any jobs
+    still queued after that are dropped instead of run.
+
+    At most `limit` jobs are queued or running at once. It defaults to
+    `size` and can be lowered (or raised back) with `set_limit`.
+    """
+    def __init__(self, size=None, limit=None):
+        size = size or UPLOAD_PARALLELIZATION
+        self.limit = min(limit or size, size)
+        self.pending = 0
+        self.slots = Condition()
+        self.queue = Queue(maxsize=size)
+        self.failed = Event()
+        self.error = None
+        self.joined = False
+        self.threads = []
+        for i in range(size):
+            thread = Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            if self.failed.is_set():
+                with self.slots:
+                    self.pending -= 1
+                    self.slots.notify()
+                continue
+            func, args = job
+            try:
+                func(*args)
+            except:
+                if not self.failed.is_set():
+                    self.error = sys.exc_info()
+                self.failed.set()
+            finally:
+                with self.slots:
+                    self.pending -= 1
+                    self.slots.notify()
+
+    def set_limit(self, limit):
+        with self.slots:
+            self.limit = min(max(limit, 1), len(self.threads))
+            self.slots.notify_all()
+
+    def submit(self, func, *args):
+        """
+        Queues `func(*args)` to run on a worker. Blocks while `limit` jobs
+        are already queued or running, i.e. until one of them finishes.
+        """
+        with self.slots:
+            while self.pending >= self.limit:
+                self.slots.wait()
+            self.pending += 1
+        self.queue.put((func, args))
+
+    def join(self, reraise=True):
+        """
+        Waits for every queued job to finish (or be dropped) and stops the
+        workers. Re-raises the first job error, if any, when `reraise` is set.
+        """
+        if not self.joined:
+            self.joined = True
+            for thread in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+        if reraise and self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+
+class PartTracker(object):
+    """
+    Keeps count of the parts of one multipart upload that are spread over a
+    shared `UploadPool`. Once `close` has been called (no more parts will be
+    added) and the last part is done, calls `finish`.
+    """
+    def __init__(self, mp_key, finish):
+        self.mp_key = mp_key
+        self.finish = finish
+        self.finished = False
+        self.outstanding = 0
+        self.closed = False
+        self.lock = Lock()
+
+    def add(self):
+        with self.lock:
+            self.outstanding += 1
+
+    def done(self):
+        with self.lock:
+            self.outstanding -= 1
+            last = self.closed and not self.outstanding
+        if last:
+            self.finish()
+            self.finished = True
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            last = not self.outstanding
+        if last:
+            self.finish()
+            self.finished = True
+
+
+def tracked_upload_worker(tracker, *args):
+    """
+    `upload_worker`, letting `tracker` know once the part is uploaded.
+    """
+    upload_worker(*args)
+    tracker.done()
+
+
+def put_worker(bucket, local_file, remote_path, headers, policy,
+        progress=None, encrypt_key=False):
+    """
+    Uploads a file smaller than `MULTIPART_THRESHOLD` with a single PUT,
+    metadata, ACL and server-side encryption (if `encrypt_key`) included.
+    """
+    key = bucket.new_key(remote_path)
+    fp = FileChunk(local_file, 0, os.stat(local_file).st_size)
+    start = time()
+    if progress:
+        progress.part_started()
+    ok = False
+    try:
+        md5 = chunk_digests(fp)[0]
+        get_retry_policy().call(key.set_contents_from_file,
+            LimitedChunk(fp, progress), headers=headers, policy=policy,
+            encrypt_key=encrypt_key, rewind=True,
+            md5=(md5.hexdigest(), base64.b64encode(md5.digest())))
+        ok = True
+    finally:
+        fp.close()
+        if progress:
+            progress.part_finished(time() - start, 0, ok)
+
+
+def upload_single_chunk(bucket, local_file, remote_path, headers, policy,
+        progress=None, encrypt_key=False):
+    """
+    Uploads a file that fits into a single chunk, start to finish.
+    """
+    mp_key = bucket.initiate_multipart_upload(remote_path, headers=headers,
+        policy=policy, encrypt_key=encrypt_key)
+    digests = PartDigests()
+    try:
+        for chunk in file_chunks(local_file):
+            upload_worker(mp_key, chunk, 1, headers, digests=digests,
+                progress=progress)
+        complete_upload(mp_key, digests)
+    except:
+        mp_key.cancel_upload()
+        raise
+
+
+def schedule_upload(pool, bucket, local_file, remote_path, cache_time=0,
+        policy="public-read", force_download=False, progress=None,
+        encrypt_key=False):
+    """
+    Queues the upload of `local_file` on `pool`, which may be shared with
+    any number of other files. Blocks only until its chunks are queued, not
+    until they are uploaded; `pool.join()` waits for everything.
+
+    A file that fits into a single chunk is uploaded by a single job (a
+    plain PUT if it is below `MULTIPART_THRESHOLD`). Larger files are
+    initiated here and each of their chunks is a job of its own; the
+    returned `PartTracker` completes the upload once the last one is done,
+    and can be used to cancel it if the pool fails.
+
+    The file's size is added to `progress` (an `UploadProgress`), if given,
+    which then follows its upload. With `encrypt_key`, S3 encrypts the file
+    at rest (SSE-S3).
+    """
+    headers = upload_headers(local_file, cache_time, force_download)
+
+    fsize = os.stat(local_file).st_size
+    if progress:
+        progress.add_total(fsize)
+    if fsize < MULTIPART_THRESHOLD:
+        pool.submit(put_worker, bucket, local_file, remote_path, headers,
+            policy, progress, encrypt_key)
+        return None
+    if fsize < 2 * CHUNK_SIZE:
+        pool.submit(upload_single_chunk, bucket, local_file, remote_path,
+            headers, policy, progress, encrypt_key)
+        return None
+
+    mp_key = bucket.initiate_multipart_upload(remote_path, headers=headers,
+        policy=policy, encrypt_key=encrypt_key)
+    digests = PartDigests()
+    tracker = PartTracker(mp_key, lambda: complete_upload(mp_key, digests))
+    for i, chunk in enumerate(file_chunks(local_file)):
+        if pool.failed.is_set():
+            break
+        tracker.add()
+        pool.submit(tracked_upload_worker, tracker, mp_key, chunk, i + 1,
+            headers, None, None, digests, progress)
+    if not pool.failed.is_set():
+        pool.submit(tracker.close)
+    return tracker
 
 
 # ========== Uploader methods ==========
 
 def easy_up(local_file, rdir=None):
-    if os.path.isfile(local_file):
+    if os.path.isfile(local_file) or (local_file != '-' and is_stream(local_file)):
         #print("File:", file=sys.stderr)
         #print(os.path.abspath(local_file), file=sys.stderr)
         #print(file=sys.stderr)
@@ -226,75 +1315,155 @@ def easy_up(local_file, rdir=None):
         print("Path given is not a file.", file=sys.stderr)
 
 
-def upload_file(local_file, bucket, remote_path, cache_time=0, policy="public-read", force_download=False):
-    # Expiration time:
-    cache_time = int(cache_time)
-
-    # Metadata that we need to pass in before attempting an upload.
-    content_type = guess_type(local_file, False)[0] \
+def upload_headers(filename, cache_time=0, force_download=False):
+    """
+    Returns the headers for a new upload of `filename`, so that its metadata
+    is set as part of the upload itself rather than patched on afterwards.
+    """
+    content_type = guess_type(filename, False)[0] \
         or "application/octet-stream"
-    basic_headers = {
+    headers = {
         "Content-Type": content_type,
     }
+    if int(cache_time) != 0:
+        headers["Cache-Control"] = \
+            "max-age=%d, must-revalidate" % int(cache_time)
+    else:
+        headers["Cache-Control"] = "no-cache, no-store"
     if force_download:
-        basic_headers["Content-Disposition"] = \
-            "attachment; filename=%s" % os.path.basename(local_file)
+        headers["Content-Disposition"] = \
+            "attachment; filename=%s" % os.path.basename(filename)
+    return headers
 
-    s3 = S3Connection(
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        host=S3_ENDPOINT
-    )
-    bucket = s3.get_bucket(bucket)
 
-    mp_key = bucket.initiate_multipart_upload(
-        remote_path,
-        headers=basic_headers
-    )
+def upload_file(local_file, bucket, remote_path, cache_time=0, policy="public-read", force_download=False, adaptive=None, resume=None, encrypt_key=False):
+    """
+    Uploads `local_file` (a path, `-` for stdin, or a named pipe) to
+    `remote_path` in `bucket` (a bucket name or an already opened bucket),
+    in parallel chunks. `encrypt_key` has S3 encrypt it at rest (SSE-S3).
+    """
+    if adaptive is None:
+        adaptive = ADAPTIVE_UPLOAD
+    if resume is None:
+        resume = RESUMABLE_UPLOADS
 
-    active_threads = []
+    # Streams (stdin or a pipe) are chunked as they are read, and get their
+    # name (for Content-Type etc.) from `remote_path` instead.
+    stream = is_stream(local_file)
+    if stream:
+        filename = remote_path
+        if resume:
+            sys.stderr.write("Can't resume an upload from a stream; " \
+                "ignoring --resume.\n")
+            resume = False
+    else:
+        filename = local_file
+
+    # Expiration time:
+    cache_time = int(cache_time)
+
+    # Metadata that we need to pass in before attempting an upload.
+    basic_headers = upload_headers(filename, cache_time, force_download)
+
+    if isinstance(bucket, basestring):
+        bucket = get_bucket(bucket)
+    bucket_name = bucket.name
+
+    progress = UploadProgress(remote_path,
+        None if stream else os.stat(local_file).st_size).start()
+
+    if not stream and os.stat(local_file).st_size < MULTIPART_THRESHOLD:
+        # Small enough that a single request beats chunking it.
+        try:
+            put_worker(bucket, local_file, remote_path, basic_headers, policy,
+                progress, encrypt_key)
+        except:
+            progress.stop('failed')
+            raise
+        progress.stop()
+        return
+
+    mp_key = None
+    journal = None
+    done = set()
+    digests = PartDigests()
+    if resume:
+        # Resumed uploads need the same chunk layout every run, so only the
+        # parallelization (not the chunk size) is adaptive.
+        fstat = os.stat(local_file)
+        chunk_sizes = [len(c) for c in file_chunks(local_file)]
+        header = {
+            'local_file': os.path.abspath(local_file),
+            'bucket': bucket_name,
+            'remote_path': remote_path,
+            'size': fstat.st_size,
+            'mtime': fstat.st_mtime,
+            'chunk_size': chunk_sizes[0],
+            'encrypt_key': encrypt_key,
+            'upload_id': None,
+        }
+        journal = UploadJournal(local_file, bucket_name, remote_path)
+        mp_key, done = resume_multipart_upload(
+            bucket, remote_path, journal, header, chunk_sizes)
+
+    if not mp_key:
+        mp_key = bucket.initiate_multipart_upload(
+            remote_path,
+            headers=basic_headers,
+            policy=policy,
+            encrypt_key=encrypt_key
+        )
+        if journal:
+            journal.start(dict(header, upload_id=mp_key.id))
+    for index in done:
+        # Already uploaded; S3 checked them against the MD5s in their ETags.
+        digests.add(index, journal.parts[index].strip('"').decode('hex'),
+            journal.sha256.get(index, '').decode('hex'))
+
+    if adaptive:
+        pool = UploadPool(MAX_UPLOAD_PARALLELIZATION, UPLOAD_PARALLELIZATION)
+        tuner = ThroughputTuner(pool)
+    else:
+        pool = UploadPool()
     try:
         # Chunk the given file into `CHUNK_SIZE` (default: 5MB) chunks
         # that can be uploaded in parallel.
-        chunk_generator = mem_chunk_file(local_file)
+        if stream:
+            chunk_generator = stream_chunks(local_file,
+                tuner if adaptive else None)
+        elif adaptive and not resume:
+            chunk_generator = adaptive_file_chunks(local_file, tuner)
+        else:
+            chunk_generator = file_chunks(local_file)
 
-        # Use `UPLOAD_PARALLELIZATION` (default: 4) threads at a time to
-        # churn through the `chunk_generator` queue.
+        # `UPLOAD_PARALLELIZATION` (default: 4) workers churn through the
+        # `chunk_generator` queue. `submit` blocks until a worker is free.
         for i, chunk in enumerate(chunk_generator):
-            args = (mp_key, chunk, i + 1, basic_headers)
-
-            # If we don't have enough concurrent threads yet, spawn an upload
-            # thread to handle this chunk.
-            if len(active_threads) < UPLOAD_PARALLELIZATION:
-                # Upload this chunk in a background thread and hold on to the
-                # thread for polling.
-                t = upload_chunk(args)
-                active_threads.append(t)
-
-            # Poll until an upload thread finishes before allowing more upload
-            # threads to spawn.
-            while len(active_threads) >= UPLOAD_PARALLELIZATION:
-                for thread in active_threads:
-                    # Kill threads that have been completed.
-                    if not thread.isAlive():
-                        thread.join()
-                        active_threads.remove(thread)
-
-                # a polling delay since there's no point in constantly waiting
-                # and taxing CPU
-                sleep(0.1)
-
-        # We've exhausted the queue, so join all of our threads so that we wait
-        # on the last pieces to complete uploading.
-        for thread in active_threads:
-            thread.join()
+            if pool.failed.is_set():
+                break
+            if (i + 1) in done:
+                continue
+            pool.submit(upload_worker, mp_key, chunk, i + 1, basic_headers,
+                tuner if adaptive else None, journal, digests, progress)
+
+        # We've exhausted the queue, so wait on the last pieces to complete
+        # uploading. Raises if any chunk failed.
+        pool.join()
     except:
         # Since we have threads running around and possibly partial data up on
         # the server, we need to clean up before propogating an exception.
+        progress.stop('failed')
         sys.stderr.write("Exception! Waiting for existing child threads to " \
             "stop.\n\n")
-        for thread in active_threads:
-            thread.join()
+        pool.failed.set()
+        pool.join(reraise=False)
+
+        if journal:
+            # Leave the uploaded chunks for the next run to pick up.
+            journal.close()
+            sys.stderr.write("Uploaded chunks were kept. Run the same " \
+                "command again with --resume to finish the upload.\n\n")
+            raise
 
         # Remove any already-uploaded chunks from the server.
         mp_key.cancel_upload()
@@ -306,23 +1475,17 @@ def upload_file(local_file, bucket, remote_path, cache_time=0, policy="public-re
         raise
     else:
         # We finished the upload successfully.
-        mp_key.complete_upload()
-        key = bucket.get_key(mp_key.key_name)
-
-    # ===== / chunked upload =====
-
-    if cache_time != 0:
-        key.set_metadata(
-            'Cache-Control',
-            'max-age=%d, must-revalidate' % int(cache_time)
-        )
-    else:
-        key.set_metadata('Cache-Control', 'no-cache, no-store')
-
-    if policy == "public-read":
-        key.make_public()
-    else:
-        key.set_canned_acl(policy)
+        try:
+            complete_upload(mp_key, digests)
+        except:
+            progress.stop('failed')
+            raise
+        progress.stop()
+        if journal:
+            journal.remove()
+        if CHECKSUM_SHA256 and digests.sha256_composite():
+            sys.stderr.write("SHA-256 (of %d chunks): %s\n"
+                % (len(digests.sha256), digests.sha256_composite()))
 
 
 def print_help():
@@ -341,9 +1504,42 @@ def print_help():
     print("s3up filename [bucket] [remote_filename] [cache_time]")
     print()
     print("s3up filename [bucket] [remote_filename] [cache_time] [policy]")
+    print()
+    print("    A filename of - uploads stdin (a named pipe also works), e.g.:")
+    print("      tar -c dir | xz | s3up - my-bucket backups/dir.tar.xz")
+    print()
+    print("Options (before the filename):")
+    print("  --adaptive  Tune parallelization and chunk size to the link while uploading.")
+    print("  --resume    Keep uploaded chunks on failure and pick up where a failed")
+    print("              upload of the same file left off.")
+    print("  --limit-rate=RATE")
+    print("              Upload at most RATE bytes/second (e.g. 500K, 2M) in total.")
+    print("  --progress=MODE")
+    print("              Report progress as a bar, json lines, both or none.")
+    print("  --sha256    Also compute a SHA-256 of every chunk and print their composite.")
 
 
 def main(args):
+    global ADAPTIVE_UPLOAD, RESUMABLE_UPLOADS, CHECKSUM_SHA256
+    global MAX_UPLOAD_RATE, UPLOAD_RATE_SCHEDULE, PROGRESS
+    if "--adaptive" in args:
+        args.remove("--adaptive")
+        ADAPTIVE_UPLOAD = True
+    if "--resume" in args:
+        args.remove("--resume")
+        RESUMABLE_UPLOADS = True
+    if "--sha256" in args:
+        args.remove("--sha256")
+        CHECKSUM_SHA256 = True
+    for arg in list(args):
+        if arg.startswith("--limit-rate="):
+            args.remove(arg)
+            MAX_UPLOAD_RATE = parse_rate(arg.split("=", 1)[1]) or None
+            UPLOAD_RATE_SCHEDULE = []
+        elif arg.startswith("--progress="):
+            args.remove(arg)
+            PROGRESS = arg.split("=", 1)[1]
+
     if len(args) == 5:
         upload_file(args[0], args[1], args[2], args[3], args[4])
     elif len(args) == 4:
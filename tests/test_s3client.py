@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Tests for `bin/s3client.py` that run a real boto `S3Connection` against a
+local HTTP server standing in for S3.
+
+Run with:
+  python tests/test_s3client.py
+"""
+import os
+import sys
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from threading import Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'bin'))
+
+import boto
+import s3client
+from boto.exception import BotoServerError
+from boto.s3.connection import OrdinaryCallingFormat
+
+SLOW_DOWN = """<?xml version="1.0" encoding="UTF-8"?>
+<Error><Code>SlowDown</Code><Message>Please reduce your request rate.</Message>
+<RequestId>1</RequestId><HostId>1</HostId></Error>"""
+
+EMPTY_LISTING = """<?xml version="1.0" encoding="UTF-8"?>
+<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">
+<Name>bucket</Name><Prefix></Prefix><Marker></Marker><MaxKeys>1000</MaxKeys>
+<IsTruncated>false</IsTruncated></ListBucketResult>"""
+
+
+class StubS3(HTTPServer):
+    """
+    Answers the first `failures` requests with a 503 SlowDown, and the rest
+    with an empty bucket listing. Counts the requests in `requests`.
+    """
+    def __init__(self, failures):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubS3Handler)
+        self.failures = failures
+        self.requests = 0
+
+
+class StubS3Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests += 1
+        if self.server.requests <= self.server.failures:
+            status, body = 503, SLOW_DOWN
+        else:
+            status, body = 200, EMPTY_LISTING
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RetryLayerTest(unittest.TestCase):
+    def setUp(self):
+        # A boto config asking for retries must not bring them back.
+        if not boto.config.has_section('Boto'):
+            boto.config.add_section('Boto')
+        boto.config.set('Boto', 'num_retries', '6')
+        s3client._connections.clear()
+
+    def start_stub(self, failures):
+        server = StubS3(failures)
+        thread = Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        connection = s3client.get_connection('access', 'secret', '127.0.0.1',
+            OrdinaryCallingFormat, port=server.server_address[1],
+            is_secure=False)
+        return server, connection.get_bucket('bucket', validate=False)
+
+    def test_boto_does_not_retry(self):
+        server, bucket = self.start_stub(failures=100)
+        try:
+            bucket.get_all_keys()
+        except BotoServerError, e:
+            self.assertEqual(e.status, 503)
+            self.assertEqual(s3client.classify_error(e), s3client.THROTTLED)
+        else:
+            self.fail("The 503 wasn't raised")
+        self.assertEqual(server.requests, 1)
+
+    def test_retry_policy_gives_up(self):
+        server, bucket = self.start_stub(failures=100)
+        policy = s3client.RetryPolicy(3, base_delay=0, max_delay=0)
+        self.assertRaises(BotoServerError, policy.call, bucket.get_all_keys)
+        self.assertEqual(server.requests, 3)
+        self.assertEqual(policy.throttles, 2)
+
+    def test_retry_policy_recovers(self):
+        server, bucket = self.start_stub(failures=2)
+        policy = s3client.RetryPolicy(5, base_delay=0, max_delay=0)
+        self.assertEqual(len(policy.call(bucket.get_all_keys)), 0)
+        self.assertEqual(server.requests, 3)
+        self.assertEqual(policy.retries, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()